@@ -1,21 +1,25 @@
 import argparse
 import torch
+import torch.distributed
 import logging
 import json
 import os
 import numpy as np
 
 from NeuralBLBF.evaluate import run_test_set
-from NeuralBLBF.train import train
+from NeuralBLBF.export import export
+from NeuralBLBF.train import CombinedOptimizer, build_optimizer, train
+from NeuralBLBF.data import FeatureHasher, ShardCache
 from NeuralBLBF.model import TinyEmbedFFNN, SmallEmbedFFNN, SparseLinear, \
-                             LargeEmbedFFNN, CrossNetwork, SparseFFNN
+                             LargeEmbedFFNN, CrossNetwork, SparseFFNN, \
+                             HashFFNN1, HashFFNN2, HashFFNN3, quantize
 
 
 if __name__ == "__main__":
     logging.basicConfig(level="INFO", format="%(asctime)s - %(levelname)s - %(message)s")
 
     parser = argparse.ArgumentParser(description='Process some integers.')
-    parser.add_argument('--mode', default='train', choices=['train', 'test'])
+    parser.add_argument('--mode', default='train', choices=['train', 'test', 'export'])
 
     # Paths to datasets
     parser.add_argument('--train', default='data/vw_compressed_train')
@@ -26,6 +30,23 @@ if __name__ == "__main__":
     parser.add_argument('--device_id', type=int, default=1)
     parser.add_argument('--feature_dict_name', type=str,
                         default='data/features_to_keys.json')
+    parser.add_argument('--hash_bits', type=int, default=None,
+                        help="Hash features into 2^hash_bits buckets instead of loading the feature dict "
+                             "(default 18 for the HashFFNN models)")
+    parser.add_argument('--stream', action='store_true',
+                        help="Stream the data instead of loading step_size lines at a time")
+    parser.add_argument('--buffer_size', type=int, default=10000,
+                        help="Number of banners in the shuffle buffer when streaming")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes parsing every chunk")
+    parser.add_argument('--pool_buckets', type=int, nargs='+', default=None,
+                        help="Pad pool sizes up to these sizes to batch them together")
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help="Number of chunks (batches when streaming) prepared in the background")
+    parser.add_argument('--cache_mb', type=int, default=0,
+                        help="Memory budget in MB for keeping parsed chunks between epochs")
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help="Directory to spill chunks evicted from the cache to")
 
     # Parameters related to training
     parser.add_argument('--lamb', type=float, default=1)
@@ -37,12 +58,25 @@ if __name__ == "__main__":
     parser.add_argument('--training_eval', action='store_true',
                         help="Also perform evaluation on training set")
     parser.add_argument('--weight_decay', type=float, default=0)
+    parser.add_argument('--clip', type=float, default=None,
+                        help="Clip the importance weights of the training loss at this value")
+    parser.add_argument('--sparse_embeddings', action='store_true',
+                        help="Use sparse embedding gradients, updated by SparseAdam, and SGD for the rest")
+    parser.add_argument('--distributed', action='store_true',
+                        help="Data-parallel training or testing over gloo, launch with torchrun")
+    parser.add_argument('--bf16', action='store_true',
+                        help="Train and test with bfloat16 autocast, keeping fp32 weights and loss")
 
     # Parameters related to the layout of the network
     parser.add_argument('--model_type', default="TinyEmbedFFNN",
                         choices=["TinyEmbedFFNN", "SmallEmbedFFNN", "SparseLinear",
-                                 "LargeEmbedFFNN", "CrossNetwork", "SparseFFNN"])
-    parser.add_argument('--sparse', action='store_true')
+                                 "LargeEmbedFFNN", "CrossNetwork", "SparseFFNN",
+                                 "HashFFNN1", "HashFFNN2", "HashFFNN3"])
+    parser.add_argument('--sparse', action='store_true',
+                        help="Use sparse input, the EmbedFFNN models then embed every category of "
+                             "fields that occur several times (needs the sparse feature dict)")
+    parser.add_argument('--bag_mode', default='sum', choices=['sum', 'mean'],
+                        help="Combine the categories of a field by their count weighted sum or mean")
     parser.add_argument('--embedding_dim', type=int, default=20)
     parser.add_argument('--hidden_dim', type=int, default=100)
     parser.add_argument('--dropout', type=float, default=0)
@@ -51,12 +85,33 @@ if __name__ == "__main__":
     parser.add_argument('--resume', type=str, default=None)
     parser.add_argument('--save', action='store_true')
     parser.add_argument('--save_model_path', type=str, default='data/models')
+    parser.add_argument('--quantize', action='store_true',
+                        help="Test or export the model with int8 Linear layers and 8-bit embeddings (CPU only)")
+    parser.add_argument('--export_path', type=str, default=None,
+                        help="Path of the exported policy (default: the save_model_path with .pt)")
 
 
     args = vars(parser.parse_args())
 
+    if args['quantize'] and (args['mode'] == 'train' or args['enable_cuda'] or args['sparse']):
+        parser.error("--quantize is for testing or exporting dense models on the CPU")
+    if args['distributed'] and args['mode'] == 'export':
+        parser.error("--distributed is for training or testing")
+    if args['mode'] == 'export' and args['resume'] is None:
+        parser.error("--mode export needs a trained model given by --resume")
+
+    # torchrun sets the rank and world size of every process, only rank 0 logs
+    args['rank'], args['world_size'] = 0, 1
+    if args['distributed']:
+        torch.distributed.init_process_group('gloo')
+        args['rank'] = torch.distributed.get_rank()
+        args['world_size'] = torch.distributed.get_world_size()
+        if args['rank'] > 0:
+            logging.getLogger().setLevel(logging.WARNING)
+
     if args['enable_cuda'] and torch.cuda.is_available():
-        device = torch.device('cuda', args['device_id'])
+        device_id = int(os.environ.get('LOCAL_RANK', 0)) if args['distributed'] else args['device_id']
+        device = torch.device('cuda', device_id)
     else:
         device = None
 
@@ -64,28 +119,43 @@ if __name__ == "__main__":
     for k, v in args.items():
         logging.info("  %12s : %s" % (k, v))
 
-    # Load dict mapping features to keys
-    with open(args['feature_dict_name']) as f: feature_dict = json.load(f)
-    if not os.path.exists(args['save_model_path']):
-        os.mkdir(args['save_model_path'])
+    # Keep parsed chunks for later epochs and evaluations
+    args['cache'] = None
+    if args['cache_mb'] > 0 or args['cache_dir'] is not None:
+        args['cache'] = ShardCache(args['cache_mb'] * 2**20, args['cache_dir'])
+
+    # Load dict mapping features to keys, or hash the features
+    if args['hash_bits'] is None and args['model_type'].startswith("Hash"):
+        args['hash_bits'] = 18
+    if args['hash_bits'] is not None:
+        feature_dict = FeatureHasher(args['hash_bits'])
+    else:
+        with open(args['feature_dict_name']) as f: feature_dict = json.load(f)
+    os.makedirs(args['save_model_path'], exist_ok=True)
 
     args['save_model_path'] = '{}/{}_{}'.format(
         args['save_model_path'], args['model_type'], args['embedding_dim']
     )
 
     # Initialize neural architecture and optimizer to use
-    if args['model_type'] == "TinyEmbedFFNN" and not args['sparse']:
+    if args['model_type'] == "TinyEmbedFFNN":
         model = TinyEmbedFFNN(feature_dict, device, **args)
     elif args['model_type'] == "SparseLinear":
-        model = SparseLinear(len(feature_dict))
+        model = SparseLinear(len(feature_dict), args['sparse_embeddings'])
     elif args['model_type'] == "SparseFFNN":
-        model = SparseFFNN(len(feature_dict))
+        model = SparseFFNN(len(feature_dict), args['sparse_embeddings'])
     elif args['model_type'] == "LargeEmbedFFNN":
         model = LargeEmbedFFNN(feature_dict, device, **args)
     elif args['model_type'] == "SmallEmbedFFNN":
         model = SmallEmbedFFNN(feature_dict, device, **args)
     elif args['model_type'] == "CrossNetwork":
         model = CrossNetwork(feature_dict, device, **args)
+    elif args['model_type'] == "HashFFNN1":
+        model = HashFFNN1(feature_dict, device, **args)
+    elif args['model_type'] == "HashFFNN2":
+        model = HashFFNN2(feature_dict, device, **args)
+    elif args['model_type'] == "HashFFNN3":
+        model = HashFFNN3(feature_dict, device, **args)
     else:
         raise NotImplementedError()
 
@@ -93,22 +163,53 @@ if __name__ == "__main__":
 
     start_epoch = 0
     optim_checkpoint = None
+    skip_message = "The checkpoint does not match the current layout, the optimizer state is not resumed."
     if args['resume'] is not None:
         checkpoint = torch.load(args['resume'])
         model.load_state_dict(checkpoint['model'])
         optim_checkpoint = checkpoint['optimizer']
+
+        # Checkpoints of older layouts are converted when loaded, the
+        # optimizer state of their parameters does not match anymore
+        state = model.state_dict()
+        if set(checkpoint['model']) != set(state) or \
+                any(checkpoint['model'][key].shape != state[key].shape for key in state):
+            logging.info(skip_message)
+            optim_checkpoint = None
         start_epoch = checkpoint['epoch']
         logging.info("Resuming from model {}. Start at epoch: {}".format(args['resume'], start_epoch))
 
     n_params = sum([np.prod(par.size()) for par in model.parameters() if par.requires_grad])
 
-    optimizer = torch.optim.SGD(model.parameters(), lr=args["learning_rate"], weight_decay=args['weight_decay'], momentum=0.9)
-    if optim_checkpoint is not None:
-        optimizer.load_state_dict(optim_checkpoint)
-    logging.info("Initialized model and optimizer. Number of parameters: {}".format(n_params))
+    # Gradients are averaged over the ranks, which start from the parameters of rank 0
+    if args['mode'] == 'train' and args['world_size'] > 1:
+        model = torch.nn.parallel.DistributedDataParallel(
+            model, device_ids=[device] if device is not None else None
+        )
+
+    logging.info("Initialized model. Number of parameters: {}".format(n_params))
 
     if args['mode'] == 'train':
+        # A checkpoint trained with another --sparse_embeddings has a different
+        # optimizer, a single one or a CombinedOptimizer
+        optimizer = build_optimizer(model, **args)
+        if optim_checkpoint is not None and \
+                isinstance(optim_checkpoint, list) != isinstance(optimizer, CombinedOptimizer):
+            logging.info(skip_message)
+            optim_checkpoint = None
+        if optim_checkpoint is not None:
+            try:
+                optimizer.load_state_dict(optim_checkpoint)
+            except ValueError:
+                logging.info(skip_message)
+                optimizer = build_optimizer(model, **args)
         train(model, optimizer, feature_dict, start_epoch, device, **args)
+    elif args['mode'] == 'export':
+        export(quantize(model) if args['quantize'] else model, feature_dict,
+               args['export_path'] or args['save_model_path'] + '.pt')
+    elif args['quantize']:
+        run_test_set(model=quantize(model), test_filename=args['test'], feature_dict=feature_dict,
+                     device=device, reference_model=model, **args)
     else:
         run_test_set(model=model, test_filename=args['test'],
                      feature_dict=feature_dict, device=device, **args)
@@ -0,0 +1,299 @@
+"""
+This script benchmarks parts of NeuralBLBF on a Criteo data file
+"""
+
+import argparse
+import gc
+import io
+import itertools
+import json
+import logging
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+
+from NeuralBLBF.data import BatchIterator, CriteoDataset, LineIndex, Sample, open_data
+from NeuralBLBF.model import TinyEmbedFFNN, SmallEmbedFFNN, LargeEmbedFFNN, CrossNetwork, quantize
+from NeuralBLBF.evaluate import autocast
+from NeuralBLBF.train import calc_loss
+
+
+def measure(build):
+    """
+        Calls build and returns its result, the number of bytes it allocated
+        and the duration of a full garbage collection while the result is alive
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.time()
+    gc.collect()
+    return result, allocated, time.time() - start
+
+
+class LegacySample():
+    """
+        A banner in the layout Samples had before CriteoShard, as the baseline
+        of benchmark_memory: an instance dict, the raw summary line and a list
+        of all 35 context and product features for every candidate
+    """
+    def __init__(self, summary, products, parser, feature_dict):
+        self.summary = summary
+        [_, click, propensity] = products[0].split("|")[0].split(":")
+        self.click = round(float(click))
+        self.propensity = float(propensity)
+        context = summary.split("|")[-1]
+        self.products = [parser.features_to_vector(context + ' ' + p.split("|")[-1], feature_dict)
+                         for p in products]
+
+
+def iter_legacy_samples(data, feature_dict, stop_idx, start_idx):
+    """
+        Yields the banners of the lines [start_idx, stop_idx) as LegacySamples,
+        the same banners as iter_samples yields
+    """
+    first_line, offset = 0, 0
+    if start_idx > 0:
+        first_line, offset = LineIndex(data).locate(start_idx)
+    parser = Sample()
+    with open_data(data, offset) as f:
+        lines = (line.decode().strip() for line in f)
+        if stop_idx != -1:
+            lines = itertools.islice(lines, max(0, stop_idx - first_line))
+        summary, products = None, []
+        for line in lines:
+            if not line: continue
+            elif "shared" in line:
+                if summary is not None:
+                    yield LegacySample(summary, products, parser, feature_dict)
+                summary, products = line, []
+            elif summary is not None:
+                products.append(line)
+
+
+def benchmark_memory(data, feature_dict, stop_idx, start_idx, **kwargs):
+    """
+        Compares the memory of a chunk stored as a list of Samples in their
+        layout before CriteoShard to the memory of the same chunk stored as a
+        CriteoShard
+        Only the dense representation is compared, as tracemalloc does not
+        see the memory of torch tensors
+    """
+    samples, list_bytes, list_gc = measure(
+        lambda: list(iter_legacy_samples(data, feature_dict, stop_idx, start_idx))
+    )
+    n_banners = len(samples)
+    del samples
+    dataset, shard_bytes, shard_gc = measure(
+        lambda: CriteoDataset(data, feature_dict, stop_idx, start_idx)
+    )
+    del dataset
+
+    n_banners = max(n_banners, 1)
+    logging.info("Banners: {}".format(n_banners))
+    logging.info("  legacy Samples  : {:10.1f} MB, {:8.1f} bytes/banner, gc {:.3f}s"
+                 .format(list_bytes / 2**20, list_bytes / n_banners, list_gc))
+    logging.info("  CriteoShard     : {:10.1f} MB, {:8.1f} bytes/banner, gc {:.3f}s"
+                 .format(shard_bytes / 2**20, shard_bytes / n_banners, shard_gc))
+
+
+def benchmark_batching(data, feature_dict, stop_idx, start_idx, batch_size, pool_buckets,
+                       embedding_dim, **kwargs):
+    """
+        Compares batching per exact pool size to padding pool sizes up to
+        pool_buckets, in steps per second and in wasted padded candidates
+        Every step is a forward and backward pass of a TinyEmbedFFNN
+    """
+    dataset = CriteoDataset(data, feature_dict, stop_idx, start_idx)
+    pool_sizes = dataset.shard.pool_sizes()
+    sizes, counts = np.unique(pool_sizes, return_counts=True)
+    logging.info("Pool sizes (size: banners): {}".format(
+        ", ".join("{}: {}".format(size, count) for size, count in zip(sizes, counts))))
+
+    model = TinyEmbedFFNN(feature_dict, None, embedding_dim, None, False, 0)
+    for name, buckets in [("exact", None), ("padded", pool_buckets)]:
+        iterator = BatchIterator(dataset, batch_size, False, False, None, buckets)
+        steps, slots = 0, 0
+        start = time.time()
+        for products, clicks, propensities, mask in iterator:
+            model.zero_grad()
+            output = model(products, mask=mask)
+            calc_loss(output, clicks, propensities, 1, 0, False, mask).backward()
+            steps += 1
+            slots += products.shape[0] * products.shape[1]
+        duration = time.time() - start
+        waste = 1 - pool_sizes.sum() / max(slots, 1)
+        logging.info("  {:6s}: {:6d} steps, {:8.1f} steps/s, {:7.2f}s per pass, {:5.1f}% padding"
+                     .format(name, steps, steps / duration, duration, 100 * waste))
+
+
+def looped_embed_fields(model, x):
+    """
+        Embeds the 35 fields with one lookup per field, like the EmbedFFNN
+        models did before their tables were fused
+    """
+    input = []
+    for i in range(x.shape[2]):
+        if i < 2:
+            input.append(x[:, :, i:i + 1])
+        else:
+            input.append(model.embedding(x[:, :, i].long() + model.field_offsets[i - 2]))
+    return torch.cat(input, dim=2)
+
+
+def random_batch(feature_dict, batch_size, pool_size):
+    """
+        returns a dense batch of random categories of every field
+    """
+    categories = [torch.randint(max(len(feature_dict[str(i)]), 1), (batch_size, pool_size))
+                  for i in range(3, 36)]
+    return torch.cat([torch.rand(batch_size, pool_size, 2) * 100,
+                      torch.stack(categories, dim=2).float()], dim=2)
+
+
+def benchmark_embedding(feature_dict, batch_size, pool_size, embedding_dim, steps, **kwargs):
+    """
+        Compares the forward and backward pass of the embeddings of a random
+        dense batch, looked up per field or with a single gather
+    """
+    model = TinyEmbedFFNN(feature_dict, None, embedding_dim, None, False, 0)
+    x = random_batch(feature_dict, batch_size, pool_size)
+    if not torch.equal(looped_embed_fields(model, x), model.embed_fields(x, 0)):
+        raise AssertionError("Fused embeddings differ from the per field embeddings")
+
+    for name, embed in [("per field", lambda: looped_embed_fields(model, x)),
+                        ("fused", lambda: model.embed_fields(x, 0))]:
+        forward, backward = 0, 0
+        for _ in range(steps):
+            model.zero_grad()
+            start = time.time()
+            out = embed()
+            forward += time.time() - start
+            start = time.time()
+            out.sum().backward()
+            backward += time.time() - start
+        logging.info("  {:9s}: forward {:7.3f} ms, backward {:7.3f} ms"
+                     .format(name, 1000 * forward / steps, 1000 * backward / steps))
+
+
+def benchmark_quantization(feature_dict, batch_size, pool_size, embedding_dim, steps, **kwargs):
+    """
+        Compares the float and the int8 quantized model of every model type
+        on the CPU, in size, latency of a single banner and throughput of
+        batches of banners
+    """
+    single = random_batch(feature_dict, 1, pool_size)
+    batch = random_batch(feature_dict, batch_size, pool_size)
+    for model_type in [TinyEmbedFFNN, SmallEmbedFFNN, LargeEmbedFFNN, CrossNetwork]:
+        model = model_type(feature_dict, None, embedding_dim=embedding_dim, hidden_dim=100,
+                           enable_cuda=False, dropout=0).eval()
+        logging.info(model_type.__name__)
+        for name, instance in [("float", model), ("int8", quantize(model))]:
+            buffer = io.BytesIO()
+            torch.save(instance.state_dict(), buffer)
+            with torch.no_grad():
+                start = time.time()
+                for _ in range(steps):
+                    instance(single, 0.0)
+                latency = (time.time() - start) / steps
+                start = time.time()
+                for _ in range(steps):
+                    instance(batch, 0.0)
+                throughput = steps * batch_size / (time.time() - start)
+            logging.info("  {:5s}: {:8.1f} MB, latency {:7.3f} ms, {:9.1f} banners/s"
+                         .format(name, len(buffer.getvalue()) / 2**20, 1000 * latency, throughput))
+
+
+def benchmark_precision(feature_dict, batch_size, pool_size, embedding_dim, steps, **kwargs):
+    """
+        Compares training steps of every model type in fp32 and with
+        bfloat16 autocast on the CPU, in steps per second and in the
+        difference of the outputs and losses from fp32
+    """
+    x = random_batch(feature_dict, batch_size, pool_size)
+    clicks = (torch.rand(batch_size) < 0.3).float()
+    propensities = torch.rand(batch_size) * 10 + 1
+    for model_type in [TinyEmbedFFNN, SmallEmbedFFNN, LargeEmbedFFNN, CrossNetwork]:
+        model = model_type(feature_dict, None, embedding_dim=embedding_dim, hidden_dim=100,
+                           enable_cuda=False, dropout=0)
+        logging.info(model_type.__name__)
+        with torch.no_grad():
+            reference = model(x, 0.0)
+            with autocast(None, True):
+                output = model(x, 0.0).float()
+        difference = (output - reference).abs().max().item()
+        loss_difference = (calc_loss(output, clicks, propensities, 1, 0, False) -
+                           calc_loss(reference, clicks, propensities, 1, 0, False)).abs().item()
+
+        for name, bf16 in [("fp32", False), ("bf16", True)]:
+            start = time.time()
+            for _ in range(steps):
+                model.zero_grad()
+                with autocast(None, bf16):
+                    output = model(x, 0.0)
+                calc_loss(output, clicks, propensities, 1, 0, False).backward()
+            logging.info("  {:4s}: {:8.2f} steps/s".format(name, steps / (time.time() - start)))
+        logging.info("  bf16 max output difference {:.2e}, loss difference {:.2e}"
+                     .format(difference, loss_difference))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(asctime)s - %(levelname)s - %(message)s")
+
+    data_parser = argparse.ArgumentParser(add_help=False)
+    data_parser.add_argument('--data', default='data/vw_compressed_train')
+    data_parser.add_argument('--feature_dict_name', type=str,
+                             default='data/features_to_keys.json')
+    data_parser.add_argument('--stop_idx', type=int, default=1000000)
+    data_parser.add_argument('--start_idx', type=int, default=0)
+
+    parser = argparse.ArgumentParser(description='Benchmarks parts of NeuralBLBF.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    subparsers.add_parser('memory', parents=[data_parser],
+                          help="Memory of a list of Samples in their old layout versus a CriteoShard")
+    batching = subparsers.add_parser('batching', parents=[data_parser],
+                                     help="Batching per pool size versus padded pool buckets")
+    batching.add_argument('--batch_size', type=int, default=256)
+    batching.add_argument('--pool_buckets', type=int, nargs='+', default=[4, 8, 16, 32])
+    batching.add_argument('--embedding_dim', type=int, default=20)
+
+    embedding = subparsers.add_parser('embedding', parents=[data_parser],
+                                      help="Per field embedding lookups versus a single fused table")
+    embedding.add_argument('--batch_size', type=int, default=256)
+    embedding.add_argument('--pool_size', type=int, default=10)
+    embedding.add_argument('--embedding_dim', type=int, default=20)
+    embedding.add_argument('--steps', type=int, default=100)
+
+    quantization = subparsers.add_parser('quantization', parents=[data_parser],
+                                         help="Float versus int8 quantized inference of every model type")
+    quantization.add_argument('--batch_size', type=int, default=256)
+    quantization.add_argument('--pool_size', type=int, default=10)
+    quantization.add_argument('--embedding_dim', type=int, default=256)
+    quantization.add_argument('--steps', type=int, default=20)
+
+    precision = subparsers.add_parser('precision', parents=[data_parser],
+                                      help="fp32 versus bfloat16 autocast training of every model type")
+    precision.add_argument('--batch_size', type=int, default=256)
+    precision.add_argument('--pool_size', type=int, default=10)
+    precision.add_argument('--embedding_dim', type=int, default=256)
+    precision.add_argument('--steps', type=int, default=20)
+
+    args = vars(parser.parse_args())
+    with open(args['feature_dict_name']) as f: feature_dict = json.load(f)
+
+    if args['benchmark'] == 'memory':
+        benchmark_memory(feature_dict=feature_dict, **args)
+    elif args['benchmark'] == 'batching':
+        benchmark_batching(feature_dict=feature_dict, **args)
+    elif args['benchmark'] == 'embedding':
+        benchmark_embedding(feature_dict=feature_dict, **args)
+    elif args['benchmark'] == 'quantization':
+        benchmark_quantization(feature_dict=feature_dict, **args)
+    elif args['benchmark'] == 'precision':
+        benchmark_precision(feature_dict=feature_dict, **args)
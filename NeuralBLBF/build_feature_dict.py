@@ -0,0 +1,167 @@
+"""
+This script builds the feature dictionaries used by the models
+Features are counted in parallel over byte ranges of the data files, the
+partial counts are merged and cut off per field by min_count and top_k
+The models map the categories that are cut off to an out-of-vocabulary row
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+
+from collections import Counter, defaultdict, deque
+
+from NeuralBLBF.data import open_data
+
+# Size of the byte ranges counted by a single task
+BLOCK_SIZE = 2**26
+
+
+def count_lines(lines):
+    """
+        Counts the features of lines of the data, without numerical values
+    """
+    counter = Counter()
+    for line in lines:
+        features = line.rsplit(b'|', 1)[-1]
+        counter.update(feature.split(b':')[0] for feature in features.split())
+    return counter
+
+
+def count_range(task):
+    """
+        Counts the features of the lines that start in a byte range of a file
+        The bytes of compressed files are read by the parent and passed along
+    """
+    filename, start, stop, data = task
+    if data is None:
+        with open(filename, 'rb') as f:
+            # Move to the first line starting at or after start
+            if start > 0:
+                f.seek(start - 1)
+                f.readline()
+            position = f.tell()
+            if position >= stop:
+                return Counter()
+            data = f.read(stop - position)
+            if not data.endswith(b'\n'):
+                data += f.readline()
+    return count_lines(data.split(b'\n'))
+
+
+def iter_tasks(filename):
+    """
+        Splits a file into byte ranges to count, compressed files are
+        decompressed here and split into blocks of whole lines
+    """
+    if not filename.endswith('.gz'):
+        size = os.path.getsize(filename)
+        for start in range(0, size, BLOCK_SIZE):
+            yield filename, start, min(start + BLOCK_SIZE, size), None
+        return
+
+    with open_data(filename) as f:
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                break
+            yield filename, 0, 0, data + f.readline()
+
+
+def count_features(filenames, workers):
+    """
+        Counts the features of all files with a pool of worker processes
+    """
+    total = Counter()
+    with multiprocessing.Pool(workers) as pool:
+        for filename in filenames:
+            logging.info("Counting features of {}".format(filename))
+
+            # Only a few tasks are pending at once, to bound the memory of
+            # blocks of compressed files
+            pending = deque()
+            for task in iter_tasks(filename):
+                pending.append(pool.apply_async(count_range, (task,)))
+                if len(pending) >= 2 * workers:
+                    total.update(pending.popleft().get())
+            while pending:
+                total.update(pending.popleft().get())
+            logging.info("  {} unique features so far".format(len(total)))
+    return {feature.decode(): count for feature, count in total.items()}
+
+
+def build_feature_dicts(counts, min_count=1, top_k=None):
+    """
+        Builds the dense and sparse feature dictionaries from feature counts
+        Within every field, categories seen fewer than min_count times or
+        outside the top_k most frequent are left out
+        The dense dictionary maps every categorical field to its categories,
+        the sparse dictionary maps the numerical fields and all
+        field_category features to a single index range
+        Categories are ordered by decreasing frequency
+    """
+    per_field = defaultdict(list)
+    for feature, count in counts.items():
+        field, _, category = feature.partition('_')
+        if field.isdigit():
+            per_field[field].append((count, category))
+
+    dense, sparse = {}, {}
+    for field in sorted(per_field, key=int):
+        # Numerical fields have no categories
+        if per_field[field][0][1] == '':
+            sparse[field] = len(sparse)
+            continue
+
+        categories = sorted(per_field[field], key=lambda c: (-c[0], c[1]))
+        categories = [category for count, category in categories if count >= min_count]
+        categories = categories[:top_k]
+        dense[field] = {category: i for i, category in enumerate(categories)}
+        for category in categories:
+            sparse[field + '_' + category] = len(sparse)
+    return dense, sparse
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format="%(asctime)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(description='Builds the feature dictionaries.')
+    parser.add_argument('--data', nargs='+', default=['data/vw_compressed_train',
+                                                      'data/vw_compressed_test',
+                                                      'data/vw_compressed_validate'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--min_count', type=int, default=1,
+                        help="Minimum count of a category within its field")
+    parser.add_argument('--top_k', type=int, default=None,
+                        help="Maximum number of categories per field")
+    parser.add_argument('--field_budget_mb', type=float, default=None,
+                        help="Memory budget of the embedding table of every field, limits top_k")
+    parser.add_argument('--embedding_dim', type=int, default=20,
+                        help="Embedding dimension the field budget is computed for")
+    parser.add_argument('--feature_dict_name', type=str,
+                        default='data/features_to_keys.json')
+    parser.add_argument('--sparse_feature_dict_name', type=str,
+                        default='data/features_to_keys_sparse.json')
+    parser.add_argument('--counts_name', type=str, default=None,
+                        help="Optionally also store the feature counts")
+    args = parser.parse_args()
+
+    top_k = args.top_k
+    if args.field_budget_mb is not None:
+        # Rows of 32 bit floats, one of which is the out-of-vocabulary row
+        budget_rows = max(int(args.field_budget_mb * 2**20 / (4 * args.embedding_dim)) - 1, 0)
+        top_k = budget_rows if top_k is None else min(top_k, budget_rows)
+
+    counts = count_features(args.data, args.workers)
+    dense, sparse = build_feature_dicts(counts, args.min_count, top_k)
+    logging.info("Kept {} of {} features".format(len(sparse), len(counts)))
+    rows = sum(len(categories) + 1 for categories in dense.values())
+    logging.info("Embedding tables of {} rows, {:.1f} MB at embedding_dim {}"
+                 .format(rows, rows * 4 * args.embedding_dim / 2**20, args.embedding_dim))
+
+    with open(args.feature_dict_name, 'w') as f: json.dump(dense, f)
+    with open(args.sparse_feature_dict_name, 'w') as f: json.dump(sparse, f)
+    if args.counts_name is not None:
+        with open(args.counts_name, 'w') as f: json.dump(counts, f)
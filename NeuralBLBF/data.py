@@ -1,16 +1,33 @@
 import argparse
+import array
+import atexit
 import torch
+import io
+import itertools
+import multiprocessing
 import os
+import queue
 import random
+import threading
+import time
 import json
-import pickle
+import shutil
+import subprocess
+import tempfile
+import gzip
 import logging
+import zlib
 import numpy as np
 
-from tqdm import tqdm
 from torch.autograd import Variable
-from torch.utils.data import Dataset
-from collections import defaultdict
+from torch.utils.data import Dataset, IterableDataset
+from collections import OrderedDict, defaultdict
+from multiprocessing import resource_tracker, shared_memory
+
+
+# The first fields are the context features of the banner, which the
+# summary line shares with every product, the rest belong to the products
+N_CONTEXT = 10
 
 
 def get_start_stop_idx(filename):
@@ -23,11 +40,698 @@ def get_start_stop_idx(filename):
     return start_idx, stop_idx
 
 
+# Decompression streams of gzip files that were left before their end, by
+# filename, opening the file again continues from them instead of from the start
+_open_streams = {}
+
+
+@atexit.register
+def _close_open_streams():
+    while _open_streams:
+        _open_streams.popitem()[1].close()
+
+
+class ReusableReader():
+    """
+        Mixin for readers of decompressed data that are kept open when their
+        with block is left before the end of the data, so that opening the same
+        file at a later offset continues decompressing from here
+    """
+    def __exit__(self, *exc_info):
+        if not self.closed and self.peek(1):
+            previous = _open_streams.pop(self.data_file, None)
+            if previous is not None: previous.close()
+            _open_streams[self.data_file] = self
+        else:
+            self.close()
+
+
+class CountingPipe(io.RawIOBase):
+    """
+        A raw reader of a pipe that counts the bytes read, so that the reader
+        on top of it knows its position
+    """
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self.pipe.readinto(buffer)
+        self.position += n or 0
+        return n
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.pipe.close()
+        super(CountingPipe, self).close()
+
+
+class DecompressedReader(ReusableReader, io.BufferedReader):
+    """
+        A binary reader of a gzip file that is decompressed by a pigz or gzip
+        process, so that decompression runs in parallel to the parsing
+    """
+    def __init__(self, filename, tool):
+        self.data_file = filename
+        self.process = subprocess.Popen([tool, '-dc', filename], stdout=subprocess.PIPE, bufsize=0)
+        super(DecompressedReader, self).__init__(CountingPipe(self.process.stdout), buffer_size=2**20)
+
+    def close(self):
+        if self.closed:
+            return
+        super(DecompressedReader, self).close()
+
+        # Stop the process if the file is closed before the end of the data
+        finished = self.process.poll() is not None
+        if not finished:
+            self.process.terminate()
+        self.process.wait()
+        if finished and self.process.returncode != 0:
+            raise IOError("Decompressing {} failed".format(self.data_file))
+
+
+class GzipReader(ReusableReader, gzip.GzipFile):
+    """
+        A binary reader of a gzip file decompressed by the gzip module, for
+        when neither pigz nor gzip is available
+    """
+    def __init__(self, filename):
+        self.data_file = filename
+        super(GzipReader, self).__init__(filename, 'rb')
+
+
+def open_data(filename, offset=0):
+    """
+        Opens a data file for binary reading, starting at a byte offset
+        Files ending in .gz are decompressed by a separate pigz or gzip process
+        if available, otherwise by the gzip module. The offset into the
+        decompressed data is reached by skipping, starting from the stream a
+        previous chunk of the file left open if it has not passed the offset,
+        so that consecutive chunks decompress the file only once
+    """
+    if not filename.endswith('.gz'):
+        f = open(filename, 'rb')
+        f.seek(offset)
+        return f
+
+    f = _open_streams.pop(filename, None)
+    if f is not None and f.tell() > offset:
+        f.close()
+        f = None
+    if f is None:
+        tool = shutil.which('pigz') or shutil.which('gzip')
+        f = DecompressedReader(filename, tool) if tool is not None else GzipReader(filename)
+    offset -= f.tell()
+    while offset > 0:
+        skipped = len(f.read(min(offset, 2**24)))
+        if not skipped: break
+        offset -= skipped
+    return f
+
+
+class LineIndex():
+    """
+        Sidecar index of a Criteo data file, mapping banner (sample) numbers and
+        line numbers to byte offsets so that a chunk can be reached with a seek
+        The index is stored next to the data file and rebuilt when it is stale
+        For gzip files the offsets are into the decompressed data
+
+        Args:
+            filename (string): Path to the criteo dataset filename
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_file = '{}.idx.npz'.format(filename)
+        if not self.load():
+            self.build()
+
+    def _stat(self):
+        stat = os.stat(self.filename)
+        return stat.st_size, stat.st_mtime_ns
+
+    def load(self):
+        """
+            Loads the index from disk, returns False if it is missing or stale
+        """
+        if not os.path.exists(self.index_file):
+            return False
+        with np.load(self.index_file) as index:
+            # Indices without n_bytes predate it and are rebuilt as well
+            if 'n_bytes' not in index.files or \
+                    (int(index['size']), int(index['mtime'])) != self._stat():
+                logging.info("Index {} is stale, rebuilding".format(self.index_file))
+                return False
+            self.banner_lines = index['banner_lines']
+            self.banner_offsets = index['banner_offsets']
+            self.n_lines = int(index['n_lines'])
+            self.n_bytes = int(index['n_bytes'])
+        return True
+
+    def build(self):
+        """
+            Scans the data file once and stores the line number and byte offset
+            of the start of every banner
+        """
+        logging.info("Building line index for {}".format(self.filename))
+        size, mtime = self._stat()
+        banner_lines = array.array('q')
+        banner_offsets = array.array('q')
+        offset = 0
+        i = -1
+        with open_data(self.filename) as f:
+            for i, line in enumerate(f):
+                if b"shared" in line:
+                    banner_lines.append(i)
+                    banner_offsets.append(offset)
+                offset += len(line)
+        self.banner_lines = np.frombuffer(banner_lines, dtype=np.int64)
+        self.banner_offsets = np.frombuffer(banner_offsets, dtype=np.int64)
+        self.n_lines = i + 1
+        self.n_bytes = offset
+
+        # Write to a temporary file first, other jobs may read the index
+        tmp_file = '{}.{}.tmp'.format(self.index_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, banner_lines=self.banner_lines, banner_offsets=self.banner_offsets,
+                     n_lines=self.n_lines, n_bytes=self.n_bytes, size=size, mtime=mtime)
+        os.replace(tmp_file, self.index_file)
+
+    def __len__(self):
+        return len(self.banner_lines)
+
+    def banner_offset(self, banner_idx):
+        """
+            returns the byte offset of the banner with the given number
+        """
+        if banner_idx >= len(self.banner_offsets):
+            return self.n_bytes
+        return int(self.banner_offsets[banner_idx])
+
+    def locate(self, line_idx):
+        """
+            returns the line number and byte offset of the first banner that
+            starts at or after the given line number
+        """
+        banner_idx = int(np.searchsorted(self.banner_lines, line_idx, side='left'))
+        if banner_idx >= len(self.banner_lines):
+            return self.n_lines, self.n_bytes
+        return int(self.banner_lines[banner_idx]), int(self.banner_offsets[banner_idx])
+
+    def banner_line(self, banner_idx):
+        """
+            returns the line number of the banner with the given number
+        """
+        if banner_idx >= len(self.banner_lines):
+            return self.n_lines
+        return int(self.banner_lines[banner_idx])
+
+    def banner_range(self, start_idx, stop_idx):
+        """
+            returns the numbers [first, last) of the banners that are read of
+            the lines [start_idx, stop_idx), or until the end for stop_idx -1
+            The last banner in range may be cut off and is dropped, like in
+            iter_samples
+        """
+        first = int(np.searchsorted(self.banner_lines, max(start_idx, 0), side='left'))
+        if stop_idx == -1:
+            last = len(self)
+        else:
+            last = int(np.searchsorted(self.banner_lines, stop_idx, side='left'))
+        return first, max(first, last - 1)
+
+    def split(self, start_idx, stop_idx, rank, world_size):
+        """
+            returns the line range of the slice of rank of the lines
+            [start_idx, stop_idx), which is split at banner boundaries so that
+            the slices of all ranks together read the banners of the range
+        """
+        first, last = self.banner_range(start_idx, stop_idx)
+        a = first + (last - first) * rank // world_size
+        b = first + (last - first) * (rank + 1) // world_size
+        if a == b:
+            return start_idx, start_idx
+
+        # The slice ends at the start of the banner after its last one, which
+        # is dropped as the last banner in range
+        return self.banner_line(a), self.banner_line(b + 1)
+
+
+def shard_path(filename, start_idx, stop_idx, sparse, hash_bits=None):
+    """
+        returns the name of the shard directory of a chunk of the filename
+    """
+    return '{}_{}-{}{}{}.shard'.format(filename, start_idx, stop_idx, '_sparse' if sparse else '',
+                                       '' if hash_bits is None else '_hash{}'.format(hash_bits))
+
+
+class CriteoShard():
+    """
+        A chunk of the Criteo dataset stored as flat NumPy arrays
+        On disk every array is a .npy file, so that a shard is opened with
+        np.memmap and costs no parsing and almost no resident memory
+
+        The context features are stored once per banner
+        Dense shards contain:
+            context (int32, n_banners x 10): context fields of every banner
+            products (int32, n_products x 25): product fields of every candidate
+        Sparse shards contain the banners and candidates in CSR layout:
+            context_indptr (int64, n_banners + 1), context_indices (int32),
+            context_values (float32)
+            indptr (int64, n_products + 1), indices (int32), values (float32)
+        Both contain:
+            offsets (int64, n_banners + 1): first candidate of every banner
+            clicks, propensities (float32, n_banners)
+    """
+    VERSION = 3
+
+    def __init__(self, arrays, sparse, n_features):
+        self.arrays = arrays
+        self.sparse = sparse
+        self.n_features = n_features
+        for name, values in arrays.items():
+            setattr(self, name, values)
+
+    @classmethod
+    def from_samples(cls, samples, sparse, n_features):
+        """
+            Converts a list of parsed Samples to a shard
+        """
+        builder = ShardBuilder(sparse, n_features)
+        for sample in samples:
+            builder.append(sample)
+        return builder.build()
+
+    @classmethod
+    def concatenate(cls, shards, sparse, n_features):
+        """
+            Concatenates a list of shards into a single in-memory shard
+        """
+        def shifted(name):
+            # Offsets of every shard continue where the previous one ended
+            parts, total = [np.zeros(1, dtype=np.int64)], 0
+            for shard in shards:
+                parts.append(shard.arrays[name][1:] + total)
+                total += int(shard.arrays[name][-1])
+            return np.concatenate(parts)
+
+        arrays = {'offsets': shifted('offsets')}
+        names = ['clicks', 'propensities']
+        if sparse:
+            names += ['indices', 'values', 'context_indices', 'context_values']
+        else:
+            names += ['products', 'context']
+        for name in names:
+            arrays[name] = np.concatenate([shard.arrays[name] for shard in shards])
+        if sparse:
+            arrays['indptr'] = shifted('indptr')
+            arrays['context_indptr'] = shifted('context_indptr')
+        return cls(arrays, sparse, n_features)
+
+    def save(self, path):
+        """
+            Writes the shard as a directory of .npy files
+        """
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        os.makedirs(tmp_path)
+        for name, values in self.arrays.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), values)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'version': self.VERSION, 'sparse': self.sparse,
+                       'n_features': self.n_features}, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open(cls, path):
+        """
+            Opens a shard written by save, returns None if it is missing or
+            written by an incompatible version
+        """
+        meta_file = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_file):
+            return None
+        with open(meta_file) as f: meta = json.load(f)
+        if meta['version'] != cls.VERSION:
+            return None
+        arrays = {}
+        for name in os.listdir(path):
+            if name.endswith('.npy'):
+                arrays[name[:-4]] = np.load(os.path.join(path, name), mmap_mode='r')
+        return cls(arrays, meta['sparse'], meta['n_features'])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def nbytes(self):
+        """
+            returns the resident size of the arrays, memory-mapped arrays are
+            paged in by the OS and not counted
+        """
+        return sum(values.nbytes for values in self.arrays.values()
+                   if not isinstance(values, np.memmap))
+
+    def pool_sizes(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, idx):
+        """
+            returns a lightweight view of banner idx, negative indices count
+            from the end
+        """
+        n = len(self)
+        if idx < 0:
+            idx += n
+        if not 0 <= idx < n:
+            raise IndexError("Banner index out of range")
+        return SampleView(self, int(idx))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield SampleView(self, idx)
+
+    def batch(self, banner_idx, pool_size):
+        """
+            Gathers the banners with indices banner_idx and returns their
+            products, clicks, propensities and candidate mask
+            Banners with fewer candidates than pool_size are padded, the mask
+            is None if there is no padding
+        """
+        starts = self.offsets[banner_idx]
+        sizes = self.offsets[banner_idx + 1] - starts
+        mask = np.arange(pool_size) < sizes[:, None]
+        rows = np.where(mask, starts[:, None] + np.arange(pool_size), 0)
+        if not self.sparse:
+            products = self.products[rows].astype(np.float32)
+            products[~mask] = 0
+            context = self.context[banner_idx].astype(np.float32)[:, None, :]
+            context = np.broadcast_to(context, (len(banner_idx), pool_size, N_CONTEXT))
+            products = torch.from_numpy(np.concatenate([context, products], axis=2))
+        else:
+            products = SparseBatch(
+                *_gather_csr(self.indptr, self.indices, self.values, rows.ravel(), mask.ravel()),
+                shape=(len(banner_idx), pool_size, self.n_features),
+                context=SparseBatch(
+                    *_gather_csr(self.context_indptr, self.context_indices,
+                                 self.context_values, banner_idx),
+                    shape=(len(banner_idx), 1, self.n_features)
+                )
+            )
+        clicks = torch.from_numpy(self.clicks[banner_idx].astype(np.float32))
+        propensities = torch.from_numpy(self.propensities[banner_idx].astype(np.float32))
+        mask = None if mask.all() else torch.from_numpy(mask)
+        return products, clicks, propensities, mask
+
+
+class ShardCache():
+    """
+        An in-process LRU cache of loaded shards, keyed by filename, line
+        range and sparsity, so that later epochs and evaluations of the same
+        chunks skip parsing
+        Shards are kept in memory up to budget bytes, the least recently used
+        ones are evicted first. With a spill_dir, evicted shards are written
+        to a temporary directory in it and opened memory-mapped when they are
+        needed again, the directory is removed when the process exits
+    """
+    def __init__(self, budget, spill_dir=None):
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.shards = OrderedDict()
+        self.spilled = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.spill_path = None
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.spill_path = tempfile.mkdtemp(prefix='spill-{}-'.format(os.getpid()), dir=spill_dir)
+            atexit.register(shutil.rmtree, self.spill_path, ignore_errors=True)
+
+    def get(self, key):
+        """
+            returns the cached shard of key, or None
+        """
+        with self.lock:
+            if key in self.shards:
+                self.shards.move_to_end(key)
+                return self.shards[key]
+            path = self.spilled.get(key)
+        return CriteoShard.open(path) if path is not None else None
+
+    def put(self, key, shard):
+        """
+            Adds a shard and evicts the least recently used shards over budget
+        """
+        with self.lock:
+            if key in self.shards:
+                self.size -= self.shards.pop(key).nbytes()
+            self.shards[key] = shard
+            self.size += shard.nbytes()
+            while self.size > self.budget and self.shards:
+                old_key, old_shard = self.shards.popitem(last=False)
+                self.size -= old_shard.nbytes()
+                self.spill(old_key, old_shard)
+
+    def spill(self, key, shard):
+        """
+            Writes an evicted shard to the spill_dir, if any
+        """
+        if self.spill_path is None or key in self.spilled or shard.nbytes() == 0:
+            return
+        path = os.path.join(self.spill_path, '{}.shard'.format(len(self.spilled)))
+        shard.save(path)
+        self.spilled[key] = path
+        logging.info("Spilled shard of {} {} to {} to {}.".format(key[0], key[1], key[2], path))
+
+
+def _gather_csr(indptr, indices, values, rows, mask=None):
+    """
+        Gathers rows of a CSR matrix in EmbeddingBag layout and returns the
+        indices, offsets and weights tensors, masked out rows are left empty
+    """
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    if mask is not None:
+        lengths = np.where(mask, lengths, 0)
+
+    # Position of every non-zero of the gathered rows in the flat arrays
+    first = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum()) + np.repeat(starts - first, lengths)
+    return (torch.from_numpy(indices[positions].astype(np.int64)),
+            torch.from_numpy(first.astype(np.int64)),
+            torch.from_numpy(values[positions].astype(np.float32)))
+
+
+class SparseBatch():
+    """
+        A batch of sparse products in EmbeddingBag layout, so that models can
+        process it with a cost that scales with the number of non-zeros
+
+        Args:
+            indices (LongTensor): feature indices of all candidates, concatenated
+            offsets (LongTensor): position in indices of the first feature of
+                every candidate, candidates are ordered by banner then by pool
+            weights (FloatTensor): feature values belonging to the indices
+            shape (tuple): batch size, pool size and number of features
+            context (SparseBatch): context features shared by the pool of
+                every banner, with a pool size of 1
+    """
+    def __init__(self, indices, offsets, weights, shape, context=None):
+        self.indices = indices
+        self.offsets = offsets
+        self.weights = weights
+        self.shape = tuple(shape)
+        self.context = context
+
+    def to(self, device):
+        context = self.context.to(device) if self.context is not None else None
+        return SparseBatch(self.indices.to(device), self.offsets.to(device),
+                           self.weights.to(device), self.shape, context)
+
+    def to_dense(self):
+        """
+            returns the batch as a dense tensor of batch x pool x features
+        """
+        n_candidates = self.shape[0] * self.shape[1]
+        ends = torch.cat([self.offsets[1:], self.offsets.new_tensor([len(self.indices)])])
+        rows = torch.repeat_interleave(torch.arange(n_candidates, device=self.offsets.device),
+                                       ends - self.offsets)
+        dense = torch.zeros(n_candidates, self.shape[2], device=self.weights.device)
+        dense.index_put_((rows, self.indices), self.weights, accumulate=True)
+        dense = dense.view(*self.shape)
+        if self.context is not None:
+            dense = dense + self.context.to_dense()
+        return dense
+
+
+class ShardBuilder():
+    """
+        Accumulates parsed Samples into the flat arrays of a CriteoShard,
+        so that the Samples and their strings can be dropped right away
+    """
+    def __init__(self, sparse, n_features):
+        self.sparse = sparse
+        self.n_features = n_features
+        self.offsets = array.array('q', [0])
+        self.clicks = array.array('f')
+        self.propensities = array.array('f')
+        if not sparse:
+            self.context = array.array('i')
+            self.products = array.array('i')
+        else:
+            self.context_indptr = array.array('q', [0])
+            self.context_indices = array.array('i')
+            self.context_values = array.array('f')
+            self.indptr = array.array('q', [0])
+            self.indices = array.array('i')
+            self.values = array.array('f')
+
+    def __len__(self):
+        return len(self.clicks)
+
+    def append(self, sample):
+        """
+            Adds a Sample on which done has been called
+        """
+        self.offsets.append(self.offsets[-1] + len(sample.products))
+        self.clicks.append(sample.click)
+        self.propensities.append(sample.propensity)
+        if not self.sparse:
+            self.context.extend(sample.context)
+            for vector in sample.products:
+                self.products.extend(vector)
+        else:
+            self.append_csr(sample.context, 'context_')
+            self.append_csr(sample.products, '')
+
+    def append_csr(self, matrix, prefix):
+        """
+            Appends the rows of a sparse tensor to the CSR arrays with a prefix
+        """
+        matrix = matrix.coalesce()
+        rows, cols = matrix.indices().numpy()
+        counts = np.bincount(rows, minlength=matrix.shape[0])
+        indptr = getattr(self, prefix + 'indptr')
+        indptr.extend((np.cumsum(counts) + indptr[-1]).tolist())
+        getattr(self, prefix + 'indices').extend(cols.astype(np.int32).tolist())
+        getattr(self, prefix + 'values').extend(matrix.values().numpy().tolist())
+
+    def build(self):
+        """
+            returns the CriteoShard holding all appended Samples
+        """
+        names = ['offsets', 'clicks', 'propensities']
+        if self.sparse:
+            names += ['indptr', 'indices', 'values',
+                      'context_indptr', 'context_indices', 'context_values']
+        else:
+            names += ['products', 'context']
+        arrays = {}
+        for name in names:
+            buffer = getattr(self, name)
+            arrays[name] = np.frombuffer(buffer, dtype=buffer.typecode) if len(buffer) else \
+                np.zeros(0, dtype=buffer.typecode)
+        if not self.sparse:
+            arrays['context'] = arrays['context'].reshape(-1, N_CONTEXT)
+            arrays['products'] = arrays['products'].reshape(-1, 35 - N_CONTEXT)
+        return CriteoShard(arrays, self.sparse, self.n_features)
+
+
+class SampleView():
+    """
+        A lightweight view of a banner of a CriteoShard, offering the
+        context, products, click and propensity of a Sample without copying them
+    """
+    __slots__ = ('shard', 'idx')
+
+    def __init__(self, shard, idx):
+        self.shard = shard
+        self.idx = idx
+
+    @property
+    def click(self):
+        return float(self.shard.clicks[self.idx])
+
+    @property
+    def propensity(self):
+        return float(self.shard.propensities[self.idx])
+
+    @property
+    def context(self):
+        if not self.shard.sparse:
+            return self.shard.context[self.idx]
+        return self.sparse_rows('context_', self.idx, self.idx + 1)
+
+    @property
+    def products(self):
+        start, stop = self.shard.offsets[self.idx], self.shard.offsets[self.idx + 1]
+        if not self.shard.sparse:
+            return self.shard.products[start:stop]
+        return self.sparse_rows('', start, stop)
+
+    def sparse_rows(self, prefix, start, stop):
+        """
+            returns rows of the CSR arrays with a prefix as a sparse tensor
+        """
+        indptr = getattr(self.shard, prefix + 'indptr')[start:stop + 1]
+        rows = np.repeat(np.arange(stop - start), np.diff(indptr))
+        cols = getattr(self.shard, prefix + 'indices')[indptr[0]:indptr[-1]]
+        values = getattr(self.shard, prefix + 'values')[indptr[0]:indptr[-1]]
+        indices = torch.from_numpy(np.stack([rows, cols]).astype(np.int64))
+        return torch.sparse_coo_tensor(indices, torch.from_numpy(values.astype(np.float32)),
+                                       (stop - start, self.shard.n_features))
+
+    def __len__(self):
+        return int(self.shard.offsets[self.idx + 1] - self.shard.offsets[self.idx])
+
+
+class FeatureHasher():
+    """
+        Replaces the feature dictionaries by hashing every field_category
+        token into 2^bits buckets, so no dictionary has to be built or loaded
+        and unseen categories still get an index
+        It acts as a sparse feature dictionary, containing every token, and
+        is recognised by Sample.get_category_index for the dense vectors
+    """
+    # Dense vectors are stored as float32, which represents integers exactly
+    # up to 2^24
+    MAX_BITS = 24
+
+    def __init__(self, bits):
+        if not 0 < bits <= self.MAX_BITS:
+            raise ValueError("hash bits must be between 1 and {}, got {}".format(self.MAX_BITS, bits))
+        self.bits = bits
+        self.mask = 2**bits - 1
+
+    def hash(self, token):
+        """
+            returns the bucket of a token, crc32 is stable across processes
+        """
+        return zlib.crc32(token.encode()) & self.mask
+
+    def __len__(self):
+        return self.mask + 1
+
+    def __contains__(self, token):
+        return True
+
+    def __getitem__(self, token):
+        return self.hash(token)
+
+
 class Sample():
     """
         A class representing a banner with one slot
         The products of the candidate pool, propensities and clicks are assigned
+        The context features of the summary are kept once, apart from the
+        products, and the raw summary string is dropped once the sample is parsed
     """
+    __slots__ = ('products', 'summary', 'context', 'click', 'propensity')
+
     def __init__(self):
 
         # Start with empty product list
@@ -35,46 +739,52 @@ class Sample():
 
         # All should be initialized by functions of the sample
         self.summary = None
+        self.context = None
         self.click = None
         self.propensity = None
 
-    def done(self, sparse, feature_dict=None):
+    def done(self, sparse, feature_dict=None, labeled=True):
         """
             Method that parses the data into it propensity, click and features
+            Unlabeled banners, such as pools to score, only have their features
+            parsed
         """
 
-        # Summary vec will be reused for all product vecs
+        # Summary holds the context features shared by all products
         summary = self.summary.split("|")[-1]
 
         # Extract click and propensity from first product
-        product_showed = self.products[0]
-        [score, features] = product_showed.split("|")
-        [_, self.click, self.propensity] = score.split(":")
-        self.click = round(float(self.click))
-        self.propensity = float(self.propensity)
+        if labeled:
+            product_showed = self.products[0]
+            [score, _] = product_showed.split("|")
+            [_, self.click, self.propensity] = score.split(":")
+            self.click = round(float(self.click))
+            self.propensity = float(self.propensity)
+        features = [p.split("|")[-1] for p in self.products]
 
-        # Extract feature vecs for every other product as well
+        # Extract the context once and the feature vecs of every product
         if not sparse:
-            first_product_vector = self.features_to_vector(summary + ' ' + features, feature_dict)
-            self.products[0] = first_product_vector
-            for i, p in enumerate(self.products[1:]):
-                vec = self.features_to_vector(summary + ' ' + p.split("|")[-1], feature_dict)
-                self.products[i+1] = vec
+            self.context = self.features_to_vector(summary, feature_dict)[:N_CONTEXT]
+            self.products = [self.features_to_vector(f, feature_dict)[N_CONTEXT:] for f in features]
         else:
-            indices_1, indices_2, values = self.features_to_vector_sparse(summary + ' ' + features, feature_dict, 0)
-            for i, p in enumerate(self.products[1:]):
-                features = summary + ' ' + p.split("|")[-1]
-                i_1, i_2, v = self.features_to_vector_sparse(features, feature_dict, i+1)
+            indices_1, indices_2, values = self.features_to_vector_sparse(summary, feature_dict, 0)
+            self.context = self.to_sparse(indices_1, indices_2, values, 1, feature_dict)
+            indices_1, indices_2, values = [], [], []
+            for i, f in enumerate(features):
+                i_1, i_2, v = self.features_to_vector_sparse(f, feature_dict, i)
                 indices_1.extend(i_1)
                 indices_2.extend(i_2)
                 values.extend(v)
-            indices = torch.LongTensor([indices_1, indices_2])
-            values = torch.FloatTensor(values)
-            self.products = Variable(torch.sparse.FloatTensor(
-                indices, values, 
-                (len(self.products), len(feature_dict))
-            ))
+            self.products = self.to_sparse(indices_1, indices_2, values, len(features), feature_dict)
+        self.summary = None
 
+    def to_sparse(self, indices_1, indices_2, values, n_rows, feature_dict):
+        """
+            Builds a sparse matrix of n_rows by the number of features
+        """
+        indices = torch.LongTensor([indices_1, indices_2]).view(2, -1)
+        values = torch.FloatTensor(values)
+        return Variable(torch.sparse.FloatTensor(indices, values, (n_rows, len(feature_dict))))
 
     def features_to_vector(self, features, feature_dict):
         """
@@ -90,9 +800,8 @@ class Sample():
             if "_" in feature:
                 [feature_name, value] = feature.split("_")
                 if ":" in value: value = value.split(":")[0]
-                category_index = self.get_category_index(int(feature_name), int(value), feature_dict)
-                if category_index is not None:
-                    vector[int(feature_name)-1] = category_index
+                vector[int(feature_name)-1] = self.get_category_index(int(feature_name), int(value),
+                                                                      feature_dict)
         return vector
 
     def features_to_vector_sparse(self, features, feature_dict, index):
@@ -124,71 +833,345 @@ class Sample():
 
     def get_category_index(self, feature, category, feature_dict):
         """
-            returns the index of the category
+            returns the index of the category, categories that are not in the
+            feature dictionary share the out-of-vocabulary index, which comes
+            after the last category of the field
         """
-        if str(category) in feature_dict[str(feature)]:
-            return feature_dict[str(feature)][str(category)]
+        if isinstance(feature_dict, FeatureHasher):
+            return feature_dict.hash('{}_{}'.format(feature, category))
+        categories = feature_dict[str(feature)]
+        return categories.get(str(category), len(categories))
+
+
+def parse_lines(lines, feature_dict, sparse, labeled=True):
+    """
+        Groups lines into banners and yields them as parsed Samples
+        The last banner is not yielded, as it may be cut off
+        If labeled is not set the click and propensity are not parsed
+    """
+    sample = None
+    for line in lines:
+        line = line.strip()
+        if not line: continue
+
+        # Start of new sample
+        elif "shared" in line:
+            if sample is not None:
+                sample.done(sparse, feature_dict, labeled)
+                yield sample
+            sample = Sample()
+            sample.summary = line
+        # Product line
         else:
-            return None
+            if sample is not None:
+                sample.products.append(line)
+
+
+def iter_samples(filename, feature_dict, stop_idx, start_idx, sparse):
+    """
+        Lazily parses the banners of the filename between two line indices
+        and yields them as Samples
+    """
+    # Product lines before the first banner in range are skipped
+    # anyway, so jump straight to the first banner at start_idx
+    first_line, offset = 0, 0
+    if start_idx > 0:
+        first_line, offset = LineIndex(filename).locate(start_idx)
+
+    # Lines are decoded one by one rather than by a read-ahead text wrapper,
+    # so that a compressed stream is left right at the end of the chunk
+    with open_data(filename, offset) as raw:
+        lines = (line.decode() for line in raw)
+        # Stop before certain index
+        if stop_idx != -1:
+            lines = itertools.islice(lines, max(0, stop_idx - first_line))
+        for sample in parse_lines(lines, feature_dict, sparse):
+            yield sample
+
+
+# Feature dict of the worker processes of load_parallel
+_worker_feature_dict = None
+
+
+def _init_worker(feature_dict):
+    global _worker_feature_dict
+    _worker_feature_dict = feature_dict
+
+
+def _to_shared(arrays):
+    """
+        Copies arrays to new shared memory blocks and returns their descriptions
+    """
+    shared = {}
+    for name, values in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        # The block is unlinked by the parent, not by this worker on exit
+        resource_tracker.unregister(block._name, 'shared_memory')
+        np.ndarray(values.shape, values.dtype, buffer=block.buf)[...] = values
+        shared[name] = (block.name, values.shape, values.dtype.str)
+        block.close()
+    return shared
+
+
+def _attach_shared(shared, blocks):
+    """
+        Attaches to shared memory blocks made by _to_shared, returns the
+        arrays viewing them
+        Every attached block is appended to blocks right away, so that the
+        caller can unlink it even if attaching a later block fails
+    """
+    arrays = {}
+    for name, (block_name, shape, dtype) in shared.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype, buffer=block.buf)
+    return arrays
+
+
+def _parse_range(task):
+    """
+        Parses the banners in a byte range of the filename in a worker process
+        The range has to start and end at banner boundaries
+        The bytes of compressed files are read by the parent and passed along
+    """
+    range_idx, (filename, start, stop, sparse, data) = task
+    if data is None:
+        with open(filename, 'rb') as f:
+            f.seek(start)
+            data = f.read(stop - start)
+    lines = data.decode().split('\n')
+
+    # Sentinel banner, so that the last banner of the range is yielded
+    lines.append("shared")
+    samples = list(parse_lines(lines, _worker_feature_dict, sparse))
+    shard = CriteoShard.from_samples(samples, sparse, len(_worker_feature_dict))
+    return range_idx, _to_shared(shard.arrays)
+
+
+def _read_ranges(filename, tasks):
+    """
+        Yields the tasks with the bytes of their range of a compressed file,
+        which is decompressed once from the start of the first range
+    """
+    with open_data(filename, tasks[0][1]) as f:
+        for task in tasks:
+            yield task[:4] + (f.read(task[2] - task[1]),)
+
+
+def load_parallel(filename, feature_dict, stop_idx, start_idx, sparse, workers):
+    """
+        Parses the banners between two line indices with a pool of worker
+        processes and returns them as a CriteoShard
+        The chunk is split into byte ranges aligned to banner boundaries
+    """
+    index = LineIndex(filename)
+    first, last = index.banner_range(start_idx, stop_idx)
+    if last <= first:
+        return CriteoShard.from_samples([], sparse, len(feature_dict))
+
+    # More ranges than workers keeps the workers busy until the end
+    n_ranges = min(last - first, workers * 4)
+    bounds = np.linspace(first, last, n_ranges + 1).astype(np.int64)
+    tasks = [(filename, index.banner_offset(a), index.banner_offset(b), sparse, None)
+             for a, b in zip(bounds[:-1], bounds[1:])]
+
+    # Compressed files can not be seeked, so they are decompressed once here
+    # and every range is read as the pool takes it, which holds no more than
+    # the ranges waiting for a worker in memory
+    if filename.endswith('.gz'):
+        tasks = _read_ranges(filename, tasks)
+
+    # Results are attached as they arrive, so that the blocks of every
+    # finished range are unlinked below, also when another range fails
+    shards = [None] * n_ranges
+    blocks = []
+    error = None
+    try:
+        with multiprocessing.Pool(workers, _init_worker, (feature_dict,)) as pool:
+            results = pool.imap_unordered(_parse_range, enumerate(tasks))
+            while True:
+                try:
+                    range_idx, description = next(results)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    if error is None: error = e
+                    continue
+                arrays = _attach_shared(description, blocks)
+                shards[range_idx] = CriteoShard(arrays, sparse, len(feature_dict))
+        if error is not None:
+            raise error
+        shard = CriteoShard.concatenate(shards, sparse, len(feature_dict))
+    finally:
+        # Views of the shared memory have to be released before closing it
+        shards = arrays = None
+        for block in blocks:
+            block.unlink()
+            try:
+                block.close()
+            except BufferError:
+                # A view is still held by a propagating exception, the memory
+                # is released with it, after the block has been unlinked here
+                pass
+    return shard
+
+
+def samples_to_batch(batch, sparse, pool_size=None):
+    """
+        Stacks a list of Samples into tensors, returns their products,
+        clicks, propensities and candidate mask
+        Samples with fewer candidates than pool_size are padded, the mask
+        is None if there is no padding
+    """
+    sizes = [len(sample.products) for sample in batch]
+    if pool_size is None: pool_size = max(sizes)
+    mask = torch.arange(pool_size).unsqueeze(0) < torch.LongTensor(sizes).unsqueeze(1)
+
+    if sparse:
+        n_features = batch[0].products.shape[1]
+        products = sparse_to_batch([sample.products for sample in batch], pool_size, n_features)
+        products.context = sparse_to_batch([sample.context for sample in batch], 1, n_features)
+    else:
+        padding = [0] * (35 - N_CONTEXT)
+        products = [[list(sample.context) + list(vector) for vector in sample.products] +
+                    [list(sample.context) + padding] * (pool_size - len(sample.products))
+                    for sample in batch]
+        products = torch.autograd.Variable(torch.FloatTensor(products))
+
+    clicks = torch.FloatTensor([sample.click for sample in batch])
+    propensities = torch.FloatTensor([sample.propensity for sample in batch])
+    mask = None if bool(mask.all()) else mask
+    return products, clicks, propensities, mask
+
+
+def sparse_to_batch(matrices, pool_size, n_features):
+    """
+        Stacks sparse matrices with at most pool_size rows into a SparseBatch
+    """
+    rows, cols, values = [], [], []
+    for i, matrix in enumerate(matrices):
+        matrix = matrix.coalesce()
+        rows.append(matrix.indices()[0] + i * pool_size)
+        cols.append(matrix.indices()[1])
+        values.append(matrix.values())
+    counts = torch.bincount(torch.cat(rows), minlength=len(matrices) * pool_size)
+    return SparseBatch(torch.cat(cols), torch.cumsum(counts, 0) - counts, torch.cat(values),
+                       (len(matrices), pool_size, n_features))
 
 
 class BatchIterator():
     """
         Iterator for the batches of products used by the neural networks
+        Dense data is stacked into one tensor per pool size up front, so that
+        a batch is a single index_select of a shuffled permutation
+        Sparse data is batched as a SparseBatch
+
+        With pool_buckets, every pool size is padded up to the smallest bucket
+        that fits it, pool sizes above the largest bucket are not padded
+        Batches are tuples of products, clicks, propensities and a mask of the
+        real candidates, which is None for unpadded batches
     """
-    def __init__(self, dataset, batch_size, enable_cuda, sparse=False, device=None):
+    def __init__(self, dataset, batch_size, enable_cuda, sparse=False, device=None,
+                 pool_buckets=None):
         self.dataset = dataset
+        if isinstance(dataset, CriteoShard):
+            self.shard = dataset
+        else:
+            self.shard = getattr(dataset, 'shard', None)
+        self.pool_buckets = sorted(pool_buckets) if pool_buckets else []
+
+        # Shards are grouped by the indices of their banners
         self.sorted_per_pool_size = defaultdict(list)
-        for s in self.dataset:
-            self.sorted_per_pool_size[len(s.products)].append(s)
+        if self.shard is not None:
+            pool_sizes = self.shard.pool_sizes()
+            for pool_size in np.unique(pool_sizes):
+                self.sorted_per_pool_size[self.bucket(pool_size)].append(
+                    np.flatnonzero(pool_sizes == pool_size))
+            for pool_size, data in self.sorted_per_pool_size.items():
+                self.sorted_per_pool_size[pool_size] = np.concatenate(data)
+        else:
+            for s in self.dataset:
+                self.sorted_per_pool_size[self.bucket(len(s.products))].append(s)
         self.sorted_per_pool_size = dict(self.sorted_per_pool_size)
         self.batch_size = batch_size
         self.enable_cuda = enable_cuda
         self.sparse = sparse
         self.device = device
 
+        # Products, clicks, propensities and masks stacked per pool size
+        self.stacked = {}
+        if not sparse:
+            for pool_size, data in self.sorted_per_pool_size.items():
+                if self.shard is not None:
+                    self.stacked[pool_size] = self.shard.batch(data, pool_size)
+                else:
+                    self.stacked[pool_size] = samples_to_batch(data, sparse, pool_size)
+
+    def bucket(self, pool_size):
+        """
+            returns the padded pool size of a banner
+        """
+        for bucket in self.pool_buckets:
+            if pool_size <= bucket:
+                return bucket
+        return int(pool_size)
+
+    def to_device(self, products, clicks, propensities, mask):
+        if self.enable_cuda:
+            products = products.to(self.device)
+            clicks = clicks.to(self.device)
+            propensities = propensities.to(self.device)
+            if mask is not None: mask = mask.to(self.device)
+        return products, clicks, propensities, mask
+
     def __iter__(self):
         keys = list(self.sorted_per_pool_size.keys())
         random.shuffle(keys)
         for pool_size in keys:
+            if pool_size in self.stacked:
+                stacked = self.stacked[pool_size]
+                permutation = torch.randperm(len(stacked[1]))
+                for i in range(0, len(permutation), self.batch_size):
+                    index = permutation[i:i+self.batch_size]
+                    yield self.to_device(*[t.index_select(0, index) if t is not None else None
+                                           for t in stacked])
+                continue
+
             data = self.sorted_per_pool_size[pool_size]
-            random.shuffle(data)
+            if self.shard is not None:
+                np.random.shuffle(data)
+            else:
+                random.shuffle(data)
             for i in range(0, len(data), self.batch_size):
                 batch = data[i:i+self.batch_size]
-                products = [sample.products for sample in batch]
-                if self.sparse:
-                    products = torch.stack([sample.products.to_dense() for sample in batch])
-                    products = torch.autograd.Variable(products)
+                if self.shard is not None:
+                    yield self.to_device(*self.shard.batch(batch, pool_size))
                 else:
-                    products = [sample.products for sample in batch]
-                    products = torch.autograd.Variable(torch.FloatTensor(products))
-                
-                clicks = torch.FloatTensor([sample.click for sample in batch])
-                propensities = torch.FloatTensor([sample.propensity for sample in batch])
-                if self.enable_cuda:
-                    products = products.to(self.device)
-                    clicks = clicks.to(self.device)
-                    propensities = propensities.to(self.device)
-                yield products, clicks, propensities
+                    yield self.to_device(*samples_to_batch(batch, self.sparse, pool_size))
 
 
 class CriteoDataset(Dataset):
     """
         A class representing the Criteo dataset
-        Loads in the data and stores it as a list of Samples
+        Loads in the data and stores it as a CriteoShard of flat arrays,
+        which is memory-mapped if the chunk was saved before
 
         Args:
             filename (string): Path to the criteo dataset filename
             stop_idx (int): only processes lines up untill here
             start_idx (int): only processes lines starting from here
+            workers (int): parses in parallel into a CriteoShard if above 1
+            cache (ShardCache): reuses the shard of an earlier load if given
     """
 
     def __init__(self, filename, features_dict, stop_idx=10000000, start_idx=0,
-                 sparse=False, save=False):
+                 sparse=False, save=False, workers=1, cache=None):
 
-        self.samples = []
+        self.shard = None
         self.save = save
         self.sparse = sparse
+        self.workers = workers
+        self.cache = cache
         self.feature_dict = features_dict
         self.load(filename, stop_idx, start_idx, sparse)
 
@@ -198,46 +1181,199 @@ class CriteoDataset(Dataset):
             loads in the data from and up to a given line index
             Uses the dataset file or a pre-made sample file
         """
-        # name of the pre-made file
-        if sparse:
-            pickle_file = '{}_{}-{}_sparse.pickle'.format(filename, start_idx, stop_idx)
-        else:
-            pickle_file = '{}_{}-{}.pickle'.format(filename, start_idx, stop_idx)
+        # name of the pre-made shard
+        hash_bits = self.feature_dict.bits if isinstance(self.feature_dict, FeatureHasher) else None
+        shard_dir = shard_path(filename, start_idx, stop_idx, sparse, hash_bits)
 
-        sample = None
+        key = (filename, start_idx, stop_idx, sparse)
+        if self.cache is not None:
+            self.shard = self.cache.get(key)
+            if self.shard is not None:
+                return
 
-        if os.path.exists(pickle_file):
-            self.samples = pickle.load(open(pickle_file, "rb"))
-        else:
-            with open(filename) as f:
-                for i, line in enumerate(f):
-                    line = line.strip()
-                    # Start after certain index
-                    if start_idx != -1 and i < start_idx: continue
-                    # Stop before certain index
-                    if stop_idx != -1 and i >= stop_idx: break
-                    if not line: continue
-
-                    # Start of new sample
-                    elif "shared" in line:
-                        if sample is not None:
-                            sample.done(self.sparse, self.feature_dict)
-                            self.samples.append(sample)
-                        sample = Sample()
-                        sample.summary = line
-                    # Product line
-                    else:
-                        if sample is not None:
-                            sample.products.append(line)
-
-                # Save for usage later
-                if self.save: pickle.dump(self.samples, open(pickle_file, 'wb'))
+        self.shard = CriteoShard.open(shard_dir)
+        if self.shard is None and self.workers > 1:
+            self.shard = load_parallel(filename, self.feature_dict, stop_idx, start_idx,
+                                       sparse, self.workers)
+            if self.save: self.shard.save(shard_dir)
+        elif self.shard is None:
+            builder = ShardBuilder(sparse, len(self.feature_dict))
+            for sample in iter_samples(filename, self.feature_dict, stop_idx, start_idx, sparse):
+                builder.append(sample)
+            self.shard = builder.build()
+
+            # Save for usage later
+            if self.save: self.shard.save(shard_dir)
+
+        if self.cache is not None:
+            self.cache.put(key, self.shard)
 
     def __len__(self):
-        return len(self.samples)
+        return len(self.shard)
 
     def __getitem__(self, idx):
-        return self.samples[idx]
+        return self.shard[idx]
+
+
+class StreamingCriteoDataset(IterableDataset):
+    """
+        A streaming version of the CriteoDataset that never holds a whole chunk
+        Banners are parsed lazily into a bounded shuffle buffer, grouped by
+        pool size, from which ready batches are drawn at random
+
+        Args:
+            filename (string): Path to the criteo dataset filename
+            stop_idx (int): only processes lines up untill here
+            start_idx (int): only processes lines starting from here
+            buffer_size (int): maximum number of banners held in the buffer
+    """
+
+    def __init__(self, filename, features_dict, stop_idx=10000000, start_idx=0,
+                 sparse=False, batch_size=256, enable_cuda=False, device=None,
+                 buffer_size=10000):
+        self.filename = filename
+        self.feature_dict = features_dict
+        self.stop_idx = stop_idx
+        self.start_idx = start_idx
+        self.sparse = sparse
+        self.batch_size = batch_size
+        self.enable_cuda = enable_cuda
+        self.device = device
+        self.buffer_size = max(buffer_size, batch_size)
+
+    def take(self, data):
+        """
+            Removes up to batch_size random samples from the buffer
+        """
+        batch = []
+        for _ in range(min(self.batch_size, len(data))):
+            j = random.randrange(len(data))
+            data[j], data[-1] = data[-1], data[j]
+            batch.append(data.pop())
+        return batch
+
+    def to_tensors(self, batch):
+        products, clicks, propensities, mask = samples_to_batch(batch, self.sparse)
+        if self.enable_cuda:
+            products = products.to(self.device)
+            clicks = clicks.to(self.device)
+            propensities = propensities.to(self.device)
+        return products, clicks, propensities, mask
+
+    def __iter__(self):
+        buffers = defaultdict(list)
+        n_buffered = 0
+        for sample in iter_samples(self.filename, self.feature_dict, self.stop_idx,
+                                   self.start_idx, self.sparse):
+            buffers[len(sample.products)].append(sample)
+            n_buffered += 1
+            if n_buffered < self.buffer_size:
+                continue
+
+            # Draw from a pool size that can fill a batch, weighted by its size
+            pool_sizes = [k for k, v in buffers.items() if len(v) >= self.batch_size]
+            if not pool_sizes:
+                pool_sizes = [max(buffers, key=lambda k: len(buffers[k]))]
+            weights = [len(buffers[k]) for k in pool_sizes]
+            pool_size = random.choices(pool_sizes, weights=weights)[0]
+            batch = self.take(buffers[pool_size])
+            n_buffered -= len(batch)
+            yield self.to_tensors(batch)
+
+        # Flush the remainder of the buffer
+        pool_sizes = list(buffers.keys())
+        random.shuffle(pool_sizes)
+        for pool_size in pool_sizes:
+            data = buffers[pool_size]
+            random.shuffle(data)
+            for i in range(0, len(data), self.batch_size):
+                yield self.to_tensors(data[i:i+self.batch_size])
+
+
+class Prefetcher():
+    """
+        Runs an iterator in a background thread that keeps up to depth of its
+        items ready in a queue, while measuring how long the consumer stalls
+        waiting for the next item
+    """
+    _done = object()
+
+    def __init__(self, iterable, depth):
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.stall_time = 0.0
+        self.thread = threading.Thread(target=self.run, args=(iterable,), daemon=True)
+        self.thread.start()
+
+    def run(self, iterable):
+        try:
+            for item in iterable:
+                self.queue.put(item)
+        except Exception as e:
+            self.error = e
+        self.queue.put(self._done)
+
+    def __iter__(self):
+        while True:
+            start = time.time()
+            item = self.queue.get()
+            self.stall_time += time.time() - start
+            if item is self._done:
+                break
+            yield item
+        if self.error is not None:
+            raise self.error
+
+
+def iterate_batches(filename, feature_dict, stop_idx, step_size, batch_size, enable_cuda,
+                    sparse, save, device, stream=False, buffer_size=10000, workers=1,
+                    pool_buckets=None, prefetch=0, cache=None, rank=0, world_size=1,
+                    description="data", **kwargs):
+    """
+        Yields all batches of the lines [0, stop_idx) of the filename
+        Either loads a CriteoDataset per step_size lines or streams the file
+        Loaded chunks are reused from the cache, if given, when not streaming
+        With prefetch, the next chunks (or batches when streaming) are
+        prepared in the background while the current ones are used
+        In distributed training, every chunk is split at banner boundaries into
+        world_size disjoint slices and only the slice of rank is read, so that
+        the ranks together read the banners of a single process
+    """
+    index = LineIndex(filename) if world_size > 1 else None
+
+    def load_chunks():
+        for i in range(0, stop_idx, step_size):
+            start, stop = i, i + step_size
+            if index is not None:
+                start, stop = index.split(start, stop, rank, world_size)
+            logging.info("Loading {} {} to {} out of {} of {}.".format(
+                description, start, stop, stop_idx, filename))
+            dataset = CriteoDataset(filename, feature_dict, stop, start, sparse, save, workers, cache)
+            yield BatchIterator(dataset, batch_size, enable_cuda, sparse, device, pool_buckets)
+
+    # Streaming yields batches, otherwise BatchIterators of whole chunks
+    if stream:
+        start, stop = 0, stop_idx
+        if index is not None:
+            start, stop = index.split(start, stop, rank, world_size)
+        logging.info("Streaming {} {} to {} of {}.".format(description, start, stop, filename))
+        source = StreamingCriteoDataset(filename, feature_dict, stop, start, sparse,
+                                        batch_size, enable_cuda, device, buffer_size)
+    else:
+        source = load_chunks()
+    if prefetch:
+        source = prefetcher = Prefetcher(source, prefetch)
+
+    for item in source:
+        if stream:
+            yield item
+        else:
+            for batch in item:
+                yield batch
+
+    if prefetch:
+        logging.info("Stalled {:.2f}s waiting for {} data.".format(prefetcher.stall_time, description))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process some integers.')
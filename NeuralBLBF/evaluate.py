@@ -1,66 +1,114 @@
 import torch
 import logging
+import math
 
 import numpy as np
-from tqdm import tqdm 
-from NeuralBLBF.data import BatchIterator, get_start_stop_idx, CriteoDataset
+from NeuralBLBF.data import iterate_batches
+
+
+def autocast(device, bf16):
+    """
+        returns the context in which the model runs in bfloat16 if bf16 is
+        set, the weights stay in fp32
+    """
+    device_type = device.type if device is not None else 'cpu'
+    return torch.autocast(device_type, dtype=torch.bfloat16, enabled=bf16)
+
+
+def log_importance_weight(scores, propensity, clip=None):
+    """
+        returns the log of the importance weight of the logged candidate, its
+        probability under the model divided by its propensity
+        The log probability is taken from the scores of the pool with
+        logsumexp, without a softmax over the pool, and padded candidates,
+        scored -inf, drop out. With clip, weights are clipped at that value
+    """
+    scores = scores[:, :, 0].float()
+    log_weight = scores[:, 0] - torch.logsumexp(scores, dim=1) - torch.log(propensity)
+    if clip is not None:
+        log_weight = torch.clamp(log_weight, max=math.log(clip))
+    return log_weight
 
 
 def run_test_set(model, test_filename, batch_size, enable_cuda, sparse,
-                 feature_dict, stop_idx, step_size, save, device, **kwargs):
+                 feature_dict, stop_idx, step_size, save, device, reference_model=None, bf16=False,
+                 rank=0, world_size=1, **kwargs):
     """
         Evaluates the model based on a test set. The following evaluation metrics will be calculated:
             - R
             - C
             - R / C
+        With a reference_model, such as the float model of a quantized model,
+        the drift of R / C from the reference model is reported as well
+        With bf16, the model runs in bfloat16 and its output is used in fp32
+        In distributed mode every rank evaluates its own slice of the test set
+        and the metrics are computed over the slices of all ranks
         Disclosure: The calculation of the metrics is inspired by the Scripts/scorer.py code provided by Criteo
     """
 
     model.eval()
-    with torch.no_grad(), open("propensities_lp.txt", 'w') as f1, open("propensities_np.txt", 'w') as f2:
-        modifiedDenomList = []
-        numerator = []
-        denominator = []
+    if reference_model is not None:
+        reference_model.eval()
+    suffix = "" if world_size == 1 else ".{}".format(rank)
+    with torch.no_grad(), open("propensities_lp{}.txt".format(suffix), 'w') as f1, \
+            open("propensities_np{}.txt".format(suffix), 'w') as f2:
+        # Running float64 sums of n, modified denominator, numerator,
+        # denominator, their squares and their product, and of the numerator
+        # and denominator of the reference model
+        sums = torch.zeros(9, dtype=torch.float64)
 
         # Extract the Numerator, Denominator and modifiedDenominator information out of the test set
-        for i in range(0, stop_idx, step_size):
-            logging.info("Loading testing {} to {} out of {} of test set: {}.".format(i, i+step_size, stop_idx, test_filename))
-            test_set = CriteoDataset(test_filename, feature_dict, i+step_size, i, sparse, save)
-            for j, (sample, click, propensity) in enumerate(BatchIterator(test_set, batch_size, enable_cuda, sparse, device)):
-                output = model(sample, 0.0)
+        batches = iterate_batches(test_filename, feature_dict, stop_idx, step_size, batch_size,
+                                  enable_cuda, sparse, save, device, rank=rank, world_size=world_size,
+                                  description="testing", **kwargs)
+        for j, (sample, click, propensity, mask) in enumerate(batches):
+            with autocast(device, bf16):
+                output = model(sample, 0.0, mask)
+            output = output.float()
+
+            rectified_label = click.eq(0).double()
+            a = click.eq(1).double() * 10 + click.eq(0).double()
+
+            c = torch.exp(log_importance_weight(output, propensity).double())
+            b = rectified_label * c
+
+            batch_sums = [a.numel(), a.sum(), b.sum(), c.sum(), (b * b).sum(), (c * c).sum(),
+                          (b * c).sum()]
+            if reference_model is not None:
+                reference = torch.exp(log_importance_weight(reference_model(sample, 0.0, mask),
+                                                            propensity).double())
+                batch_sums += [(rectified_label * reference).sum(), reference.sum()]
+            for k, value in enumerate(batch_sums):
+                sums[k] += float(value)
+            output = torch.softmax(output, dim=1).squeeze(2)
+
+            # Save propensities to text file for later analysis
+            for c, p in zip(list(click.cpu().numpy()), list(output[:, 0].cpu().numpy())):
+                f1.write("{}\t{}\n".format(c, p))
+            sampling = torch.multinomial(output, 1, replacement=False).cpu().numpy()
+            for c, index, prop in zip(click.cpu().numpy(), sampling, output.cpu().numpy()):
+                f2.write("{}\n".format(prop[index[0]]))
+
+        if world_size > 1:
+            torch.distributed.all_reduce(sums)
+        (maxInstances, modifiedDenom, sum_numerator, sum_denominator, sum_numerator_sq,
+         sum_denominator_sq, sum_product, reference_numerator, reference_denominator) = sums.tolist()
 
-                rectified_label = click.eq(0).float()
-                a = click.eq(1) * 10 + click.eq(0)
-                modifiedDenomList.extend(a.cpu().numpy())
-
-                b = rectified_label * (output[:, 0, 0] / propensity)
-
-                numerator.extend(b.cpu().numpy())
-
-                c = output[:, 0, 0] / propensity
-
-                denominator.extend(c.cpu().numpy())
-                output = output.squeeze(2)
-
-                # Save propensities to text file for later analysis
-                for c, p in zip(list(click.cpu().numpy()), list(output[:, 0].cpu().numpy())):
-                    f1.write("{}\t{}\n".format(c, p))
-                sampling = torch.multinomial(output, 1, replacement=False).cpu().numpy()
-                for c, index, prop in zip(click.cpu().numpy(), sampling, output.cpu().numpy()):
-                    f2.write("{}\n".format(prop[index[0]]))
-
-        modifiedDenom = sum(modifiedDenomList)
         power = 10**4
-        maxInstances = len(modifiedDenomList)
         scaleFactor = np.sqrt(maxInstances) / modifiedDenom
 
+        # Population standard deviation from the sums of x and x^2
+        def std(sum_x, sum_x_sq):
+            mean = sum_x / maxInstances
+            return np.sqrt(max(sum_x_sq / maxInstances - mean * mean, 0.0))
+
         # Calculate R values
-        R = (np.sum(numerator) / modifiedDenom)
-        R_std = 2.58 * np.std(numerator) * scaleFactor  # 99% CI
+        R = sum_numerator / modifiedDenom
+        R_std = 2.58 * std(sum_numerator, sum_numerator_sq) * scaleFactor  # 99% CI
 
         # Calculate C values
-        C = np.sum(denominator) / modifiedDenom
-        C_std = 2.58 * np.std(denominator) * scaleFactor  # 99% CI
+        C = sum_denominator / modifiedDenom
+        C_std = 2.58 * std(sum_denominator, sum_denominator_sq) * scaleFactor  # 99% CI
 
         # Calculate R/C values
         R_div_C = R / C
@@ -68,11 +116,17 @@ def run_test_set(model, test_filename, batch_size, enable_cuda, sparse,
 
         # See Art Owen, Monte Carlo, Chapter 9, Section 9.2, Page 9
         # Delta Method to compute an approximate CI for SN-IPS
-        Var = np.sum(np.square(numerator) + \
-                        np.square(denominator) * R_div_C * R_div_C - \
-                        2 * R_div_C * np.multiply(numerator, denominator), dtype=np.longdouble) / (
-                          normalizer * normalizer)
+        Var = (sum_numerator_sq + sum_denominator_sq * R_div_C * R_div_C -
+               2 * R_div_C * sum_product) / (normalizer * normalizer)
+        Var = max(Var, 0.0)
         R_div_C_std = 2.58 * np.sqrt(Var) / np.sqrt(maxInstances)  # 99% CI
 
         logging.info("Test Results: R x 10^4: {:.4f}+/-{:.3f}\t C: {:.4f}+/-{:.3f}\t (R x 10^4) / C: {:.4f}+/-{:.3f}"
                      .format(R*power, R_std*power, C, C_std, R_div_C*power, R_div_C_std*power))
+
+        if reference_model is not None:
+            # The modified denominator cancels out of R / C
+            reference_R_div_C = reference_numerator / reference_denominator
+            logging.info("Reference model: (R x 10^4) / C: {:.4f}\t drift: {:+.4f} ({:+.3f}%)"
+                         .format(reference_R_div_C*power, (R_div_C - reference_R_div_C)*power,
+                                 100 * (R_div_C / reference_R_div_C - 1)))
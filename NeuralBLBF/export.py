@@ -0,0 +1,61 @@
+"""
+Exports trained EmbedFFNN models as self-contained TorchScript policies,
+which NeuralBLBF.score loads without the training code
+The vocabulary is stored in the artifact: the dense feature dictionary, or
+the number of hash bits of hashed models
+"""
+
+import json
+import logging
+
+import torch
+from torch import nn
+
+from NeuralBLBF.data import FeatureHasher
+
+
+class Policy(nn.Module):
+    """
+        Wraps a model for scoring, so that it takes only the dense batch of
+        products, runs without dropout and returns the probabilities of the
+        candidates
+    """
+    def __init__(self, model):
+        super(Policy, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return torch.softmax(self.model(x, 0.0), dim=1)
+
+
+def export(model, feature_dict, path):
+    """
+        Traces a model on the CPU and saves it to path together with its
+        vocabulary, only the dense input of the EmbedFFNN models is supported
+    """
+    if not hasattr(model, 'field_offsets'):
+        raise ValueError("Only EmbedFFNN models with dense input can be exported")
+    model = model.cpu().eval()
+    if isinstance(feature_dict, FeatureHasher):
+        vocabulary = {'hash_bits': feature_dict.bits}
+    else:
+        vocabulary = {'feature_dict': feature_dict}
+
+    # Category 0 exists in every field, so an all zero pool is a valid input
+    example = torch.zeros(1, 10, 35)
+    with torch.no_grad():
+        traced = torch.jit.trace(Policy(model), example)
+    torch.jit.save(traced, path, _extra_files={'vocabulary.json': json.dumps(vocabulary)})
+    logging.info("Exported the policy to {}".format(path))
+
+
+def load(path):
+    """
+        returns the policy saved by export and its feature dictionary
+    """
+    extra_files = {'vocabulary.json': ''}
+    policy = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+    vocabulary = json.loads(extra_files['vocabulary.json'])
+    if 'hash_bits' in vocabulary:
+        return policy, FeatureHasher(vocabulary['hash_bits'])
+    return policy, vocabulary['feature_dict']
@@ -1,31 +1,275 @@
 from torch import nn
 import torch
 import torch.nn.functional as F
+import copy
 import math
 
+from NeuralBLBF.data import FeatureHasher, SparseBatch, N_CONTEXT
+
+
+class SparseInputLinear(nn.EmbeddingBag):
+    """
+        A Linear layer over many sparse features, which keeps its weight as an
+        (in_features, out_features) table, so that a SparseBatch only reads the
+        rows of its non-zero features and, with sparse, only their gradients
+        Dense inputs are multiplied with the whole table
+    """
+    def __init__(self, in_features, out_features, bias=True, sparse=False):
+        super(SparseInputLinear, self).__init__(in_features, out_features, mode='sum', sparse=sparse)
+        if bias:
+            self.bias = nn.Parameter(torch.empty(out_features))
+        else:
+            self.register_parameter('bias', None)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Initialized like nn.Linear, whose fan in is the number of features
+        bound = 1 / math.sqrt(self.num_embeddings)
+        nn.init.uniform_(self.weight, -bound, bound)
+        if getattr(self, 'bias', None) is not None:
+            nn.init.uniform_(self.bias, -bound, bound)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        """
+            Transposes the (out_features, in_features) weight of checkpoints of
+            an nn.Linear layer
+        """
+        weight = state_dict.get(prefix + 'weight')
+        if weight is not None and weight.shape != self.weight.shape and \
+                weight.shape == self.weight.shape[::-1]:
+            state_dict[prefix + 'weight'] = weight.t().contiguous()
+        super(SparseInputLinear, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x):
+        if not isinstance(x, SparseBatch):
+            return F.linear(x, self.weight.t(), self.bias)
+
+        batch_dim, pool_size, _ = x.shape
+        out = F.embedding_bag(x.indices, self.weight, x.offsets, mode='sum',
+                              per_sample_weights=x.weights, sparse=self.sparse)
+        out = out.view(batch_dim, pool_size, -1)
+
+        # Context features are shared by the pool and added once per banner
+        if x.context is not None:
+            context = x.context
+            out = out + F.embedding_bag(context.indices, self.weight, context.offsets, mode='sum',
+                                        per_sample_weights=context.weights,
+                                        sparse=self.sparse).unsqueeze(1)
+        if self.bias is not None:
+            out = out + self.bias
+        return out
+
+
+def factorized_linear(context, products, linear):
+    """
+        Applies a Linear layer to the concatenation of the context and the
+        products, without concatenating them
+        The context part of the layer is computed once per banner and added
+        to the product part of every candidate
+    """
+    # Quantized layers have no weight to slice
+    if not isinstance(linear, nn.Linear):
+        return linear(torch.cat([context.expand(-1, products.shape[1], -1), products], dim=2))
+
+    n_context = context.shape[2]
+    out = F.linear(context, linear.weight[:, :n_context], linear.bias)
+    return out + F.linear(products, linear.weight[:, n_context:])
+
+
+def quantize(model):
+    """
+        returns a copy of an EmbedFFNN model for int8 inference on the CPU,
+        with dynamically quantized Linear layers and an 8-bit embedding table
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    qconfig = {nn.Linear: torch.quantization.default_dynamic_qconfig,
+               nn.Embedding: torch.quantization.float_qparams_weight_only_qconfig}
+    mapping = {nn.Linear: torch.nn.quantized.dynamic.Linear,
+               nn.Embedding: torch.nn.quantized.Embedding}
+    return torch.quantization.quantize_dynamic(model, qconfig, mapping=mapping)
+
+
+def mask_padding(scores, mask):
+    """
+        Sets the scores of padded candidates to -inf, so that the softmax over
+        the pool gives them zero probability
+        All models return these scores, the softmax is left to the loss and
+        the evaluation, which only need the logged candidate
+    """
+    if mask is None:
+        return scores
+    return scores.masked_fill(~mask.unsqueeze(2), float('-inf'))
+
 
 class EmbedFFNN(nn.Module):
     """
         The EmbedFFNN model represents the superclass of all models,
         containing embedding layers to reduce the input dimensionality
+        The embedded input has input_dim = 33*embedding_dim + 2 values, the
+        embeddings of the categorical fields and the two numerical fields
+        With sparse_embeddings, the gradients of the embeddings are sparse and
+        only hold the rows used in a batch
     """
-    def __init__(self, feature_dict, device, embedding_dim, enable_cuda):
+    # Weights of the subclasses whose input starts with the embedded fields
+    embedded_inputs = []
+
+    def __init__(self, feature_dict, device, embedding_dim, enable_cuda, sparse=False,
+                 bag_mode='sum', sparse_embeddings=False, **kwargs):
         super(EmbedFFNN, self).__init__()
 
-        # Embedding layers
+        # Embedding layers, the numerical fields are passed on as they are
         self.embedding_dim = embedding_dim
-        self.embedding_layers = []
-        for i in range(3, 36):
-            self.embedding_layers.append(
-                nn.Embedding(len(feature_dict[str(i)]), embedding_dim)
-            )
-        self.embedding_layers = nn.ModuleList(self.embedding_layers)
+        self.input_dim = 33 * embedding_dim + 2
+        self.field_sizes = None
+        if sparse:
+            self.init_bags(feature_dict, bag_mode, sparse_embeddings)
+            return
+        if isinstance(feature_dict, FeatureHasher):
+            # The field is part of every hashed token, so all fields share
+            # the table of hash buckets
+            sizes = [0] * 33
+            n_rows = len(feature_dict)
+        else:
+            # Every field has a last row for out-of-vocabulary categories
+            sizes = [len(feature_dict[str(i)]) + 1 for i in range(3, 36)]
+            n_rows = sum(sizes)
+            self.field_sizes = sizes
+
+        # All categorical fields are stored in one table, every field starts
+        # at its own row offset, so that all fields are looked up at once
+        offsets = torch.tensor([0] + sizes[:-1], dtype=torch.long).cumsum(0)
+        self.register_buffer('field_offsets', offsets, persistent=False)
+        self.embedding = nn.Embedding(n_rows, embedding_dim, sparse=sparse_embeddings)
 
         if enable_cuda:
-            for i in range(33):
-                self.embedding_layers[i] = self.embedding_layers[i].to(device)
-
-    def forward(self, x):
+            self.to(device)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        """
+            Converts older checkpoints, with one embedding layer per field,
+            without out-of-vocabulary rows or with the numerical fields
+            repeated embedding_dim times
+            Unknown categories used to get category 0, so its row is copied
+            to the out-of-vocabulary row. The columns of a repeated field are
+            summed into a single column. Both give the same output
+        """
+        keys = ['{}embedding_layers.{}.weight'.format(prefix, i) for i in range(33)]
+        blocks = None
+        if keys[0] in state_dict:
+            blocks = [state_dict.pop(key) for key in keys]
+        elif self.field_sizes is not None and prefix + 'embedding.weight' in state_dict:
+            weight = state_dict[prefix + 'embedding.weight']
+            if len(weight) == sum(self.field_sizes) - 33:
+                blocks = torch.split(weight, [size - 1 for size in self.field_sizes])
+        if blocks is not None:
+            if self.field_sizes is not None:
+                blocks = [torch.cat([block, block[:1]]) if len(block) == size - 1 else block
+                          for block, size in zip(blocks, self.field_sizes)]
+            state_dict[prefix + 'embedding.weight'] = torch.cat(blocks)
+
+        d = self.embedding_dim
+        parameters = dict(self.named_parameters())
+        for name in self.embedded_inputs:
+            weight = state_dict.get(prefix + name)
+            if weight is not None and weight.shape[-1] == parameters[name].shape[-1] + 2 * d - 2:
+                state_dict[prefix + name] = torch.cat([weight[..., :d].sum(-1, keepdim=True),
+                                                       weight[..., d:2 * d].sum(-1, keepdim=True),
+                                                       weight[..., 2 * d:]], dim=-1)
+        super(EmbedFFNN, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def init_bags(self, feature_dict, bag_mode, sparse_embeddings):
+        """
+            Creates a single EmbeddingBag over the sparse feature dictionary,
+            so that every field embeds all of its categories with their
+            counts, instead of only the last one in the dense vectors
+            The field of every feature is looked up in feature_fields
+        """
+        if isinstance(feature_dict, FeatureHasher):
+            raise ValueError("Sparse input of the EmbedFFNN models needs a sparse feature dictionary")
+        if bag_mode not in ('sum', 'mean'):
+            raise ValueError("bag_mode must be sum or mean, got {}".format(bag_mode))
+        fields = torch.full((len(feature_dict),), -1, dtype=torch.long)
+        for feature, index in feature_dict.items():
+            field = feature.split('_')[0]
+            if field.isdigit():
+                fields[index] = int(field) - 1
+        self.register_buffer('feature_fields', fields)
+        self.embedding_bag = nn.EmbeddingBag(len(feature_dict), self.embedding_dim, mode='sum',
+                                             sparse=sparse_embeddings)
+        self.bag_mode = bag_mode
+
+    def embed(self, x):
+        """
+            Embeds the 35 fields of every candidate
+        """
+        context, products = self.embed_parts(x)
+        return torch.cat([context.expand(-1, products.shape[1], -1), products], dim=2)
+
+    def embed_parts(self, x):
+        """
+            Embeds the context fields and the product fields apart
+            The context fields are the same for the whole pool, so they are
+            embedded once per banner, with a pool size of 1
+        """
+        if isinstance(x, SparseBatch):
+            context = self.embed_bags(x.context, 0, N_CONTEXT)
+            products = self.embed_bags(x, N_CONTEXT, 35)
+        else:
+            context = self.embed_fields(x[:, :1, :N_CONTEXT], 0)
+            products = self.embed_fields(x[:, :, N_CONTEXT:], N_CONTEXT)
+        return context, products
+
+    def embed_bags(self, x, first, last):
+        """
+            Embeds the fields [first, last) of every candidate of a
+            SparseBatch, every categorical field as a bag of its categories
+            weighted by their counts, summed or averaged by bag_mode
+        """
+        n_rows, n_fields = x.shape[0] * x.shape[1], last - first
+        ends = torch.cat([x.offsets[1:], x.offsets.new_tensor([len(x.indices)])])
+        rows = torch.repeat_interleave(torch.arange(n_rows, device=x.offsets.device),
+                                       ends - x.offsets)
+        fields = self.feature_fields[x.indices] - first
+        keep = (fields >= 0) & (fields < n_fields)
+        rows, fields, indices, weights = rows[keep], fields[keep], x.indices[keep], x.weights[keep]
+
+        # Numerical fields keep their value, like in embed_fields
+        numerical = fields + first < 2
+        values = torch.zeros(n_rows, n_fields, device=weights.device)
+        values.index_put_((rows[numerical], fields[numerical]), weights[numerical], accumulate=True)
+
+        # The bags of every candidate and field have to be contiguous
+        categorical = ~numerical
+        bags = rows[categorical] * n_fields + fields[categorical]
+        bags, order = torch.sort(bags, stable=True)
+        weights = weights[categorical][order]
+        counts = torch.bincount(bags, minlength=n_rows * n_fields)
+        if self.bag_mode == 'mean':
+            totals = torch.zeros(n_rows * n_fields, device=weights.device).index_add_(0, bags, weights)
+            weights = weights / totals[bags]
+        embedded = self.embedding_bag(indices[categorical][order], torch.cumsum(counts, 0) - counts,
+                                      per_sample_weights=weights)
+
+        n_numerical = max(2 - first, 0)
+        embedded = embedded.view(n_rows, n_fields, -1)[:, n_numerical:].flatten(1)
+        out = torch.cat([values[:, :n_numerical], embedded], dim=1)
+        return out.view(x.shape[0], x.shape[1], -1)
+
+    def embed_fields(self, x, first):
+        """
+            Embeds consecutive fields, starting at field index first
+            All categorical fields are looked up in the table with a single
+            gather, the numerical fields are passed on as a single value each
+        """
+        n_numerical = max(2 - first, 0)
+        fields = slice(first + n_numerical - 2, first + x.shape[2] - 2)
+        categories = x[:, :, n_numerical:].long() + self.field_offsets[fields]
+        out = self.embedding(categories.flatten()).view(*categories.shape[:2], -1)
+        if n_numerical:
+            out = torch.cat([x[:, :, :n_numerical], out], dim=2)
+        return out
+
+    def forward(self, x, p=None, mask=None):
         raise NotImplementedError()
 
 
@@ -33,52 +277,41 @@ class SmallEmbedFFNN(EmbedFFNN):
     """
          The SmallEmbedFFNN model consist of the following layers
             - Embedding layers (embedding_dim)
-            - Linear layer (35*embedding_dim -> 512)
+            - Linear layer (33*embedding_dim + 2 -> 512)
             - Dropout layer (probability p)
             - ReLU layer
             - Linear layer (512 -> 256)
             - Dropout layer (probability p)
             - ReLU layer
             - Linear layer (256 -> 1)
-            - Softmax layer
     """
+    embedded_inputs = ['linear1.weight']
+
     def __init__(self, feature_dict, device, embedding_dim, hidden_dim, enable_cuda, dropout, **kwargs):
-        super(SmallEmbedFFNN, self).__init__(feature_dict, device, embedding_dim, enable_cuda)
-        self.linear1 = nn.Linear(35 * embedding_dim, 512)
+        super(SmallEmbedFFNN, self).__init__(feature_dict, device, embedding_dim, enable_cuda, **kwargs)
+        self.linear1 = nn.Linear(self.input_dim, 512)
         self.linear2 = nn.Linear(512, 256)
         self.linear3 = nn.Linear(256, 1)
         self.relu = nn.ReLU()
-        self.softmax = nn.Softmax(dim=1)
         self.dropout = dropout
 
-    def forward(self, x, p=None):
+    def forward(self, x, p=None, mask=None):
         if p is None: p = self.dropout
-        batch_dim, pool_size, _ = x.shape
-        input = []
-        for i in range(35):
-            if i < 2:
-                tensor = x[:, :, i].unsqueeze(2)
-                tensor = tensor.repeat(1, 1, self.embedding_dim)
-                input.append(tensor)
-            else:
-                tensor = self.embedding_layers[i-2](x[:, :, i].long())
-                input.append(tensor)
-
-        out = torch.cat(input, dim=2)
-        out = F.dropout(self.linear1(out), p=p)
+        out = factorized_linear(*self.embed_parts(x), self.linear1)
+        out = F.dropout(out, p=p)
         out = self.relu(out)
         out = F.dropout(self.linear2(out), p=p)
         out = self.relu(out)
         out = self.linear3(out)
 
-        return self.softmax(out)
+        return mask_padding(out, mask)
 
 
 class LargeEmbedFFNN(EmbedFFNN):
     """
           The LargeEmbedFFNN model consist of the following layers
              - Embedding layers (embedding_dim)
-             - Linear layer (35*embedding_dim -> 2048)
+             - Linear layer (33*embedding_dim + 2 -> 2048)
              - Dropout layer (probability p)
              - ReLU layer
              - Linear layer (2048 -> 1024)
@@ -88,33 +321,22 @@ class LargeEmbedFFNN(EmbedFFNN):
              - Dropout layer (probability p)
              - ReLU layer
              - Linear layer (256 -> 1)
-             - Softmax layer
     """
+    embedded_inputs = ['linear1.weight']
+
     def __init__(self, feature_dict, device, embedding_dim, hidden_dim, enable_cuda, dropout, **kwargs):
-        super(LargeEmbedFFNN, self).__init__(feature_dict, device, embedding_dim, enable_cuda)
-        self.linear1 = nn.Linear(35 * embedding_dim, 2048)
+        super(LargeEmbedFFNN, self).__init__(feature_dict, device, embedding_dim, enable_cuda, **kwargs)
+        self.linear1 = nn.Linear(self.input_dim, 2048)
         self.linear2 = nn.Linear(2048, 1024)
         self.linear3 = nn.Linear(1024, 256)
         self.linear4 = nn.Linear(256, 1)
         self.relu = nn.ReLU()
-        self.softmax = nn.Softmax(dim=1)
         self.dropout = dropout
 
-    def forward(self, x, p=None):
+    def forward(self, x, p=None, mask=None):
         if p is None: p = self.dropout
-        batch_dim, pool_size, _ = x.shape
-        input = []
-        for i in range(35):
-            if i < 2:
-                tensor = x[:, :, i].unsqueeze(2)
-                tensor = tensor.repeat(1, 1, self.embedding_dim)
-                input.append(tensor)
-            else:
-                tensor = self.embedding_layers[i-2](x[:, :, i].long())
-                input.append(tensor)
-
-        out = torch.cat(input, dim=2)
-        out = F.dropout(self.linear1(out), p=p)
+        out = factorized_linear(*self.embed_parts(x), self.linear1)
+        out = F.dropout(out, p=p)
         out = self.relu(out)
         out = F.dropout(self.linear2(out), p=p)
         out = self.relu(out)
@@ -122,46 +344,56 @@ class LargeEmbedFFNN(EmbedFFNN):
         out = self.relu(out)
         out = self.linear4(out)
 
-        return self.softmax(out)
+        return mask_padding(out, mask)
 
 
 class TinyEmbedFFNN(EmbedFFNN):
     """
          The TinyEmbedFFNN model consist of the following layers
             - Embedding layers (embedding_dim)
-            - Linear layer (35*embedding_dim -> 256)
+            - Linear layer (33*embedding_dim + 2 -> 256)
             - Dropout layer (probability p)
             - ReLU layer
             - Linear layer (256 -> 1)
-            - Softmax layer
     """
+    embedded_inputs = ['linear1.weight']
+
     def __init__(self, feature_dict, device, embedding_dim, hidden_dim, enable_cuda, dropout, **kwargs):
-        super(TinyEmbedFFNN, self).__init__(feature_dict, device, embedding_dim, enable_cuda)
-        self.linear1 = nn.Linear(35 * embedding_dim, 256)
+        super(TinyEmbedFFNN, self).__init__(feature_dict, device, embedding_dim, enable_cuda, **kwargs)
+        self.linear1 = nn.Linear(self.input_dim, 256)
         self.linear2 = nn.Linear(256, 1)
         self.relu = nn.ReLU()
-        self.softmax = nn.Softmax(dim=1)
         self.dropout = dropout 
 
-    def forward(self, x, p=None):
+    def forward(self, x, p=None, mask=None):
         if p is None: p = self.dropout
-        batch_dim, pool_size, _ = x.shape
-        input = []
-        for i in range(35):
-            if i < 2:
-                tensor = x[:, :, i].unsqueeze(2)
-                tensor = tensor.repeat(1, 1, self.embedding_dim)
-                input.append(tensor)
-            else:
-                tensor = self.embedding_layers[i-2](x[:, :, i].long())
-                input.append(tensor)
-
-        out = torch.cat(input, dim=2)
-        out = F.dropout(self.linear1(out), p=p)
+        out = factorized_linear(*self.embed_parts(x), self.linear1)
+        out = F.dropout(out, p=p)
         out = self.relu(out)
         out = self.linear2(out)
 
-        return self.softmax(out)
+        return mask_padding(out, mask)
+
+
+class HashFFNN1(TinyEmbedFFNN):
+    """
+         The HashFFNN1 model is the TinyEmbedFFNN, with one hidden layer, on
+         features hashed by a FeatureHasher
+    """
+
+
+class HashFFNN2(SmallEmbedFFNN):
+    """
+         The HashFFNN2 model is the SmallEmbedFFNN, with two hidden layers, on
+         features hashed by a FeatureHasher
+    """
+
+
+class HashFFNN3(LargeEmbedFFNN):
+    """
+         The HashFFNN3 model is the LargeEmbedFFNN, with three hidden layers, on
+         features hashed by a FeatureHasher
+    """
 
 
 class SparseFFNN(nn.Module):
@@ -170,42 +402,36 @@ class SparseFFNN(nn.Module):
             - Linear layer (n_features -> 32)
             - ReLU layer
             - Linear layer (32 -> 1)
-            - Softmax layer
+         With sparse_embeddings, the gradient of the first layer is sparse
     """
-    def __init__(self, n_features):
+    def __init__(self, n_features, sparse_embeddings=False):
         super(SparseFFNN, self).__init__()
 
-        self.linear1 = nn.Linear(n_features, 32, bias=True)
+        self.linear1 = SparseInputLinear(n_features, 32, bias=True, sparse=sparse_embeddings)
         self.linear2 = nn.Linear(32, 1, bias=True)
         self.relu = nn.ReLU()
-        self.softmax = nn.Softmax(dim=1)
 
-    def forward(self, feature_vector, p=None):
+    def forward(self, feature_vector, p=None, mask=None):
         out = self.linear1(feature_vector)
         out = self.relu(out)
         out = self.linear2(out)
-        probability = self.softmax(out)
-
-        return probability
+        return mask_padding(out, mask)
 
 
 class SparseLinear(nn.Module):
     """
          The SparseLinear model consist of the following layers
             - Linear layer (n_features -> 1)
-            - Softmax layer
+         With sparse_embeddings, the gradient of the layer is sparse
     """
-    def __init__(self, n_features):
+    def __init__(self, n_features, sparse_embeddings=False):
         super(SparseLinear, self).__init__()
 
-        self.linear = nn.Linear(n_features, 1, bias=False)
-        self.softmax = nn.Softmax(dim=1)
+        self.linear = SparseInputLinear(n_features, 1, bias=False, sparse=sparse_embeddings)
 
-    def forward(self, feature_vector, p=None):
+    def forward(self, feature_vector, p=None, mask=None):
         score = self.linear(feature_vector)
-        probability = self.softmax(score)
-
-        return probability
+        return mask_padding(score, mask)
 
 
 
@@ -232,44 +458,36 @@ class CrossNetwork(EmbedFFNN):
          The CrossNetwork model is based on the paper:
          Deep & Cross Network for Ad Click Predictions by Wang et al. (2017), which explains this structure in detail.
     """
+    embedded_inputs = ['cross_layer1.weight.weight', 'cross_layer2.weight.weight',
+                       'cross_layer3.weight.weight', 'dnn_layer1.weight', 'final_layer.weight']
+
     def __init__(self, feature_dict, device, embedding_dim, hidden_dim, enable_cuda, **kwargs):
-        super(CrossNetwork, self).__init__(feature_dict, device, embedding_dim, enable_cuda)
+        super(CrossNetwork, self).__init__(feature_dict, device, embedding_dim, enable_cuda, **kwargs)
         
         # Cross Network
-        self.cross_layer1 = CrossLayer(embedding_dim*35)
-        self.cross_layer2 = CrossLayer(embedding_dim*35)
-        self.cross_layer3 = CrossLayer(embedding_dim*35)
+        self.cross_layer1 = CrossLayer(self.input_dim)
+        self.cross_layer2 = CrossLayer(self.input_dim)
+        self.cross_layer3 = CrossLayer(self.input_dim)
 
         # Regular Deep Neural Network
-        self.dnn_layer1 = nn.Linear(35 * embedding_dim, 1024)
+        self.dnn_layer1 = nn.Linear(self.input_dim, 1024)
         self.dnn_layer2 = nn.Linear(1024, 768)
         self.dnn_layer3 = nn.Linear(768, 512)
         self.relu = nn.ReLU()
-        self.final_layer = nn.Linear(512 + embedding_dim*35, 1)
-        self.softmax = nn.Softmax(dim=1)
+        self.final_layer = nn.Linear(512 + self.input_dim, 1)
 
-    def forward(self, x):
-        batch_dim, pool_size, _ = x.shape
-        embedded = []
-        for i in range(35):
-            if i < 2:
-                tensor = x[:, :, i].unsqueeze(2)
-                tensor = tensor.repeat(1, 1, self.embedding_dim)
-                embedded.append(tensor)
-            else:
-                tensor = self.embedding_layers[i-2](x[:, :, i].long())
-                embedded.append(tensor)
-        embedded = torch.cat(embedded, dim=2)
-        x_0 = embedded
+    def forward(self, x, p=None, mask=None):
+        context, products = self.embed_parts(x)
+        x_0 = torch.cat([context.expand(-1, products.shape[1], -1), products], dim=2)
         x = self.cross_layer1(x_0, x_0)
         x = self.cross_layer2(x, x_0)
         x_cross = self.cross_layer3(x, x_0)
         
-        x = self.relu(self.dnn_layer1(x_0))
+        x = self.relu(factorized_linear(context, products, self.dnn_layer1))
         x = self.relu(self.dnn_layer2(x))
         x_dnn = self.relu(self.dnn_layer3(x))
 
         out = self.final_layer(torch.cat((x_cross, x_dnn), dim=2))
 
-        return self.softmax(out)
+        return mask_padding(out, mask)
 
@@ -0,0 +1,44 @@
+"""
+This script scores the candidate pools of a Criteo data file, or of stdin,
+with a policy exported by python -m NeuralBLBF --mode export
+For every banner a line with the probabilities of its candidates is written
+"""
+
+import argparse
+import itertools
+import sys
+
+import torch
+
+from NeuralBLBF.data import open_data, parse_lines
+from NeuralBLBF.export import load
+
+
+def score(policy, feature_dict, lines, out):
+    """
+        Scores the banners of the lines and writes their probabilities to out
+    """
+    # Sentinel banner, so that the last banner is scored too
+    lines = itertools.chain(lines, ["shared"])
+    with torch.no_grad():
+        # Pools to score need not carry a click and propensity
+        for sample in parse_lines(lines, feature_dict, False, labeled=False):
+            pool = torch.tensor([[sample.context + vector for vector in sample.products]],
+                                dtype=torch.float32)
+            probabilities = policy(pool)[0, :, 0].tolist()
+            out.write(" ".join("{:.6g}".format(p) for p in probabilities) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Scores candidate pools with an exported policy.')
+    parser.add_argument('policy', help="Policy saved by python -m NeuralBLBF --mode export")
+    parser.add_argument('data', nargs='?', default='-',
+                        help="Data file in the Criteo format, or - for stdin")
+    args = parser.parse_args()
+
+    policy, feature_dict = load(args.policy)
+    if args.data == '-':
+        score(policy, feature_dict, sys.stdin, sys.stdout)
+    else:
+        with open_data(args.data) as f:
+            score(policy, feature_dict, (line.decode() for line in f), sys.stdout)
@@ -1,27 +1,82 @@
 import torch
+import contextlib
 import logging
 import datetime
 
-import numpy as np
-from tqdm import tqdm
+from torch import nn
 
-from NeuralBLBF.data import CriteoDataset, BatchIterator
+from NeuralBLBF.evaluate import autocast, log_importance_weight, run_test_set
+from NeuralBLBF.data import iterate_batches
 
 
-from NeuralBLBF.evaluate import run_test_set
-from NeuralBLBF.data import BatchIterator, get_start_stop_idx, CriteoDataset
+class CombinedOptimizer():
+    """
+        Steps several optimizers as one, such as a sparse optimizer for the
+        embeddings and a dense optimizer for the rest of the model
+    """
+    def __init__(self, *optimizers):
+        self.optimizers = optimizers
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        if not isinstance(state_dicts, list) or len(state_dicts) != len(self.optimizers):
+            raise ValueError("The optimizer state does not match the {} combined optimizers"
+                             .format(len(self.optimizers)))
+        for optimizer, state_dict in zip(self.optimizers, state_dicts):
+            optimizer.load_state_dict(state_dict)
 
 
-def calc_loss(output_tensor, click_tensor, propensity_tensor, lamb, gamma, enable_cuda):
+def build_optimizer(model, learning_rate, weight_decay, sparse_embeddings=False, **kwargs):
     """
-        Calculates the loss and returns the result
+        returns SGD with momentum for the model, or with sparse_embeddings,
+        SparseAdam for the embeddings combined with SGD for the other
+        parameters, so that a step only updates the embedding rows of a batch
+        Models without sparse embeddings fall back to SGD
+    """
+    embeddings = [module.weight for module in model.modules()
+                  if isinstance(module, (nn.Embedding, nn.EmbeddingBag)) and module.sparse]
+    if sparse_embeddings and not embeddings:
+        logging.warning("The model has no sparse embeddings, using SGD for all parameters")
+    if not sparse_embeddings or not embeddings:
+        return torch.optim.SGD(model.parameters(), lr=learning_rate, weight_decay=weight_decay,
+                               momentum=0.9)
+
+    if weight_decay:
+        logging.warning("SparseAdam has no weight decay, weight_decay {} only applies to the "
+                        "dense parameters".format(weight_decay))
+    sparse_ids = set(id(parameter) for parameter in embeddings)
+    dense = [parameter for parameter in model.parameters() if id(parameter) not in sparse_ids]
+    return CombinedOptimizer(
+        torch.optim.SparseAdam(embeddings, lr=learning_rate),
+        torch.optim.SGD(dense, lr=learning_rate, weight_decay=weight_decay, momentum=0.9)
+    )
+
+
+def calc_loss(output_tensor, click_tensor, propensity_tensor, lamb, gamma, enable_cuda, mask=None,
+              clip=None):
+    """
+        Calculates the loss from the scores of the model and returns the result
+        Only the logged candidate at index 0 is used, which is never padding,
+        and the model has already given padded candidates a score of -inf
+        The importance weights are formed in log space and optionally clipped
+        at clip, the loss is reduced in fp32, also for bfloat16 outputs
     """
 
     # Calculate the corrected N
     N_hat = torch.sum(click_tensor.eq(1) * 10 + click_tensor.eq(0)).float()
 
     # Calculate the off policy probability
-    probs = (output_tensor[:, 0, 0] / propensity_tensor)
+    probs = torch.exp(log_importance_weight(output_tensor, propensity_tensor, clip))
 
     # Calculate the final loss
     R_hat = (click_tensor - lamb) * probs
@@ -30,48 +85,67 @@ def calc_loss(output_tensor, click_tensor, propensity_tensor, lamb, gamma, enabl
 
 def train(model, optimizer, feature_dict, start_epoch, device, save_model_path, train, test,
           batch_size, enable_cuda, epochs, lamb, gamma, sparse, stop_idx, step_size,
-          save, **kwargs):
+          save, bf16=False, clip=None, rank=0, world_size=1, **kwargs):
     """
         Training function, initiates training/testing/saving of the model
+        In distributed mode the model is wrapped in DistributedDataParallel,
+        every rank trains on its own slice of the data, the evaluation covers
+        the slices of all ranks and rank 0 saves the model
     """
     epoch_losses = []
     logging.info("Initialized dataset")
 
+    # Evaluation and checkpoints use the model without its wrapper
+    module = model.module if world_size > 1 else model
+
     # Evaluate the model based on the test set and optionally the train set
-    run_test_set(model, test, batch_size, enable_cuda, sparse, feature_dict, stop_idx, step_size, save, device)
+    run_test_set(module, test, batch_size, enable_cuda, sparse, feature_dict, stop_idx, step_size, save, device,
+                 bf16=bf16, rank=rank, world_size=world_size, **kwargs)
     if kwargs['training_eval']:
-       run_test_set(model, train, batch_size, enable_cuda, sparse, feature_dict, stop_idx, step_size, save, device)
+       run_test_set(module, train, batch_size, enable_cuda, sparse, feature_dict, stop_idx, step_size, save, device,
+                    bf16=bf16, rank=rank, world_size=world_size, **kwargs)
 
     # Train the model
     for i in range(start_epoch, epochs, 1):
         logging.info("Starting epoch {}".format(i))
 
         losses = []
-        for j in range(0, stop_idx, step_size):
-
-            logging.info("Loading training {} to {} out of {}.".format(j, j+step_size, stop_idx))
-            train_set = CriteoDataset(train, feature_dict, j+step_size, j, sparse, save)
-            for k, (sample, click, propensity) in enumerate(BatchIterator(train_set, batch_size, enable_cuda, sparse, device)):
+        batches = iterate_batches(train, feature_dict, stop_idx, step_size, batch_size, enable_cuda,
+                                  sparse, save, device, rank=rank, world_size=world_size,
+                                  description="training", **kwargs)
+
+        # Ranks may get different numbers of batches, join keeps the
+        # gradient all-reduce of the ranks that are not done yet going
+        with model.join() if world_size > 1 else contextlib.nullcontext():
+            for k, (sample, click, propensity, mask) in enumerate(batches):
                 optimizer.zero_grad()
-                output = model(sample)
-                loss = calc_loss(output, click, propensity, lamb, gamma, enable_cuda)
+                with autocast(device, bf16):
+                    output = model(sample, mask=mask)
+                loss = calc_loss(output, click, propensity, lamb, gamma, enable_cuda, mask, clip)
                 losses.append(loss.item())
 
                 loss.backward()
                 optimizer.step()
-        epoch_losses.append(sum(losses) / len(losses))
+
+        totals = torch.tensor([sum(losses), len(losses)], dtype=torch.float64)
+        if world_size > 1:
+            torch.distributed.all_reduce(totals)
+        epoch_losses.append((totals[0] / totals[1]).item())
         logging.info("Finished epoch {}, avg. loss {}".format(i, epoch_losses[-1]))
 
         # Evaluate the model based on the test set and optionally the train set
-        run_test_set(model, test, batch_size, enable_cuda, sparse, feature_dict, stop_idx, step_size, save, device)
+        run_test_set(module, test, batch_size, enable_cuda, sparse, feature_dict, stop_idx, step_size, save, device,
+                     bf16=bf16, rank=rank, world_size=world_size, **kwargs)
         if kwargs['training_eval']:
-            run_test_set(model, train, batch_size, enable_cuda, sparse, feature_dict, stop_idx, step_size, save, device)
-
-        # Save the model
-        state = {
-            'model': model.state_dict(),
-            'optimizer': optimizer.state_dict(),
-            'epoch': i
-        }
-        logging.info("Saving after completed epoch {}".format(i))
-        torch.save(state, save_model_path + 'e{}-{}.pt'.format(i, datetime.datetime.now()))
+            run_test_set(module, train, batch_size, enable_cuda, sparse, feature_dict, stop_idx, step_size, save, device,
+                         bf16=bf16, rank=rank, world_size=world_size, **kwargs)
+
+        # Save the model, all ranks hold the same parameters
+        if rank == 0:
+            state = {
+                'model': module.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'epoch': i
+            }
+            logging.info("Saving after completed epoch {}".format(i))
+            torch.save(state, save_model_path + 'e{}-{}.pt'.format(i, datetime.datetime.now()))